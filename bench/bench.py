@@ -0,0 +1,258 @@
+'''Benchmarks the stages of ingesting a HealthPro Work Queue CSV, at several
+file sizes, against the SQLite stand-in for SQL Server (see standin.py). For
+each size, a synthetic CSV is generated (see workqueue.py) and each stage is
+timed, along with the peak memory (resident set size) of the process while 
+it ran:
+
+  encoding     quick check of the BOM and encoding (head and tail only)
+  format       quick check of the banner/trailer rows; rowcount estimate
+  standardize  one pass over the file stripping the extraneous rows,
+               decoding each line, and computing the digest
+  parse        CSV parsing plus conversion to the db column types
+  load         load_healthpro_csv, as an ingest runs it (so it includes
+               reading and parsing the file again)
+  verify       the rowcount checks after the load
+
+Each size runs in a process of its own, so the memory figures of one don't
+carry over into the next. Timings against the stand-in are no substitute for
+SQL Server's, but they're comparable from run to run.
+
+Usage (from the repo folder, with the ingester's dependencies installed):
+
+  python bench/bench.py [--rows 10000,100000,1000000] [--json out.json]
+                        [--compare earlier.json] [--dir work_dir]
+
+--json saves the results; --compare shows how each timing changed since an
+earlier saved run. The work folder (a temp folder, by default) is deleted
+afterwards unless --dir is given.'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.normpath(os.path.join(HERE, '..'))
+sys.path[:0] = [HERE, REPO]
+import workqueue
+import standin
+
+DEFAULT_ROWS = [10000, 100000, 1000000]
+STAGES = ['encoding', 'format', 'standardize', 'parse', 'load', 'verify']
+TABLE_SQL_FILES = ['create-healthpro-table.sql', 'create-metadata-table.sql',
+                   'create-redcap-table.sql']
+CSV_NAME = 'workqueue_BENCH_20180101-000000.csv'
+
+# How often (in seconds) the memory sampler checks the process's RSS.
+RSS_SAMPLE_SECS = 0.005
+
+#------------------------------------------------------------------------------
+# memory
+
+def current_rss():
+  '''Resident set size of this process, in bytes (Linux only; else None).'''
+  try:
+    with open('/proc/self/statm') as f:
+      return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+  except (IOError, OSError, ValueError):
+    return None
+
+class PeakRss(threading.Thread):
+  '''Samples this process's RSS from a thread of its own; peak() is the
+  highest seen since the last reset().'''
+
+  def __init__(self):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self._peak = current_rss()
+
+  def run(self):
+    while True:
+      self._peak = max(self._peak, current_rss())
+      time.sleep(RSS_SAMPLE_SECS)
+
+  def reset(self):
+    self._peak = current_rss()
+
+  def peak(self):
+    return max(self._peak, current_rss())
+
+#------------------------------------------------------------------------------
+# setup
+
+def create_standin_db(path):
+  scripts = []
+  for fname in TABLE_SQL_FILES:
+    with open(os.path.join(REPO, 'sql', fname)) as f:
+      scripts.append(f.read())
+  standin.create_db(path, scripts)
+
+def write_config(work_dir):
+  cfg = {'db_info': {'host': 'standin',
+                     'database': os.path.join(work_dir, 'standin.sqlite')},
+         'db_backend': 'standin',
+         'from_email': 'bench@example.com', 'to_email': 'bench@example.com',
+         'notify_backend': 'file',
+         'consortium_tag': 'BENCH',
+         'inbox_dir': os.path.join(work_dir, 'inbox'),
+         'archive_dir': os.path.join(work_dir, 'archive'),
+         'healthpro_table_name': '[dm_aou].[dbo].[healthpro]',
+         'metadata_table_name': '[dm_aou].[dbo].[metadata]',
+         'redcap_table_name': '[dm_aou].[dbo].[rc_prj_2525]',
+         'redcap_job_name': 'bench',
+         'agent_job_timeout': 60}
+  os.mkdir(os.path.join(work_dir, 'enclave'))
+  os.mkdir(cfg['inbox_dir'])
+  os.mkdir(cfg['archive_dir'])
+  with open(os.path.join(work_dir, 'enclave',
+                         'healthproimporter_config.json'), 'w') as f:
+    json.dump(cfg, f, indent=1)
+
+#------------------------------------------------------------------------------
+# running
+
+def run_one(nrows, work_dir):
+  '''Benchmark one file size, in this process. Returns map of results.'''
+  os.mkdir(work_dir)
+  write_config(work_dir)
+  create_standin_db(os.path.join(work_dir, 'standin.sqlite'))
+  path = os.path.join(work_dir, 'inbox', CSV_NAME)
+  t = time.time()
+  workqueue.write_workqueue(path, nrows)
+  gen_secs = time.time() - t
+  # main reads its config (and writes its log) relative to the current
+  # folder.
+  os.chdir(work_dir)
+  import main
+  pl = main.pipelines[0]
+  state = {}
+
+  def check_encoding():
+    state['sample'] = main.sample_file(path)
+    assert main.check_char_encoding_is_utf8sig(state['sample'])
+
+  def check_format():
+    assert main.check_hp_csv_format(state['sample'])
+    main.estimate_csv_rowcount(state['sample'])
+
+  def standardize():
+    csvfile = main.HealthProCsv(path)
+    for _ in csvfile._body_lines():
+      pass
+    assert csvfile.encoding_ok and csvfile.format_ok
+
+  def parse():
+    csvfile, rows = main.handle_csv(path)
+    converter = main.RowConverter(csvfile.header,
+                                  main.db_column_info_for(
+                                    pl.healthpro_table_name))
+    for _ in converter.convert_rows(rows):
+      pass
+    assert converter.error_count == 0 and csvfile.rowcount == nrows
+
+  def load():
+    csvfile, rows = main.handle_csv(path)
+    main.load_healthpro_csv(pl, CSV_NAME, csvfile, rows, 0)
+    state['csvfile'] = csvfile
+
+  def verify():
+    rowcount = state['csvfile'].rowcount
+    db_rowcount = main.db_curr_rowcount(pl.healthpro_table_name, rowcount)
+    assert main.check_csv_rowcount(rowcount, db_rowcount)
+    assert db_rowcount == nrows
+
+  funcs = dict(zip(STAGES, [check_encoding, check_format, standardize, parse,
+                            load, verify]))
+  sampler = PeakRss()
+  sampler.start()
+  stages = []
+  for name in STAGES:
+    # Each stage starts cold, as the first ingest after a restart would.
+    main.datetime_cache.clear()
+    rss_before = current_rss()
+    sampler.reset()
+    t = time.time()
+    funcs[name]()
+    secs = time.time() - t
+    peak = sampler.peak()
+    stages.append({'stage': name, 'secs': secs, 'peak_rss': peak,
+                   'rss_growth': peak - rss_before})
+  main.db_pool.close_all()
+  return {'rows': nrows, 'file_bytes': os.path.getsize(path),
+          'generate_secs': gen_secs, 'stages': stages}
+
+def run_sizes(sizes, work_dir):
+  '''Run each size in a separate process; returns list of results.'''
+  results = []
+  for n in sizes:
+    print >> sys.stderr, 'Benchmarking {:,} rows...'.format(n)
+    out = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                   '--one', str(n), '--dir',
+                                   os.path.join(work_dir, str(n))])
+    results.append(json.loads(out.strip().splitlines()[-1]))
+  return results
+
+#------------------------------------------------------------------------------
+# reporting
+
+def mb(nbytes):
+  return '{:.1f}'.format(nbytes / 1048576.0)
+
+def report(results, earlier=None):
+  earlier_secs = {}
+  for r in earlier or []:
+    for s in r['stages']:
+      earlier_secs[(r['rows'], s['stage'])] = s['secs']
+  for r in results:
+    print '{:,} rows ({} MB; generated in {:.1f} secs)'.format(
+        r['rows'], mb(r['file_bytes']), r['generate_secs'])
+    print '  {:<12} {:>9} {:>10} {:>13} {:>12}'.format(
+        'stage', 'secs', 'rows/sec', 'peak RSS MB', 'growth MB')
+    for s in r['stages']:
+      line = '  {:<12} {:>9.3f} {:>10} {:>13} {:>12}'.format(
+          s['stage'], s['secs'],
+          '{:,.0f}'.format(r['rows'] / s['secs']) if s['secs'] else '-',
+          mb(s['peak_rss']), mb(s['rss_growth']))
+      before = earlier_secs.get((r['rows'], s['stage']))
+      if before:
+        line += '  ({:+.0%} vs. earlier)'.format(s['secs'] / before - 1)
+      print line
+    print
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the ingester.')
+  parser.add_argument('--rows', default=','.join(str(n) for n in
+                                                 DEFAULT_ROWS),
+                      help='comma-separated file sizes, in rows')
+  parser.add_argument('--json', help='save results to this file')
+  parser.add_argument('--compare', help='results saved by an earlier run')
+  parser.add_argument('--dir', help='work folder (kept afterwards)')
+  parser.add_argument('--one', type=int, help=argparse.SUPPRESS)
+  args = parser.parse_args()
+  if args.one:
+    print json.dumps(run_one(args.one, args.dir))
+    return
+  work_dir = args.dir or tempfile.mkdtemp(prefix='ingester-bench-')
+  try:
+    if not os.path.exists(work_dir):
+      os.makedirs(work_dir)
+    results = run_sizes([int(x) for x in args.rows.split(',')], work_dir)
+  finally:
+    if not args.dir:
+      shutil.rmtree(work_dir, True)
+  earlier = None
+  if args.compare:
+    with open(args.compare) as f:
+      earlier = json.load(f)
+  report(results, earlier)
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump(results, f, indent=1)
+
+if __name__ == '__main__':
+  main()
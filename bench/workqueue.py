@@ -0,0 +1,112 @@
+'''Generates synthetic HealthPro Work Queue CSVs for benchmarking: the BOM, 
+the confidentiality banner and trailer rows, and the columns of 
+sql/create-healthpro-table.sql, with made-up (but realistically shaped) 
+values. The same nrows and seed always give the same file.
+
+Usage: python bench/workqueue.py <output path> <nrows> [seed]'''
+
+import os
+import sys
+import re
+import csv
+import codecs
+import random
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TABLE_SQL = os.path.join(HERE, '..', 'sql', 'create-healthpro-table.sql')
+
+# Same as HP_CSV_FIRST_ROW etc. in main.py.
+BANNER_ROWS = ['"This file contains information that is sensitive and '
+               'confidential. Do not distribute either the file or its '
+               'contents."', '""']
+TRAILER_ROWS = ['""', '"Confidential Information"']
+
+FIRST_NAMES = ['Maria', 'James', 'Wei', 'Fatima', 'Jose', 'Aisha', 'John',
+               'Mei', 'Carlos', 'Olga', u'Jos\xe9', u'Zo\xeb', 'Ana']
+LAST_NAMES = ['Smith', 'Garcia', 'Chen', 'Johnson', 'Rodriguez', 'Khan', 
+              "O'Brien", 'Nguyen', 'Williams', u'Mu\xf1oz', 'Lee', 'Brown']
+STREETS = ['Main St', 'Broadway', 'York Ave', '1st Ave', 'Park Ave', 
+           'Ocean Pkwy', 'Grand Concourse']
+CITIES = [('New York', 'NY'), ('Brooklyn', 'NY'), ('Bronx', 'NY'), 
+          ('Jersey City', 'NJ'), ('Yonkers', 'NY')]
+CHOICES = {
+  'Language': ['English', 'Spanish', 'Chinese', ''],
+  'Participant Status': ['Core Participant', 'Member', 'Withdrawn', ''],
+  'Sex': ['Male', 'Female', 'Intersex', 'Skip', ''],
+  'Gender Identity': ['Man', 'Woman', 'Non-Binary', 'Skip', ''],
+  'Race/Ethnicity': ['White', 'Black', 'Hispanic', 'Asian', 'More Than One',
+                     'Skip', ''],
+  'Education': ['College Graduate', 'High School', 'Advanced Degree', 'Skip',
+                ''],
+  'Biospecimens': ['0', '1', '2', '3', '4', '5', '6', '7'],
+}
+SITES = ['Weill Cornell', 'Columbia', 'Harlem Hospital', 'NYU Langone', '']
+
+def table_columns(path=TABLE_SQL):
+  '''Returns list of (name, type, max length) for the HealthPro table.'''
+  cols = re.findall(r'\[([^\]]+)\]\s+(NVARCHAR|DATE)(?:\((\d+)\))?',
+                    open(path).read(), re.I)
+  return [(name, typ.upper(), int(n or 0)) for name, typ, n in cols]
+
+def random_date(r, start_year=2017, end_year=2018):
+  return '{}/{}/{}'.format(r.randint(1, 12), r.randint(1, 28),
+                           r.randint(start_year, end_year))
+
+def value_for(r, i, name, typ, max_len):
+  if name == 'PMI ID':
+    return 'P{:09d}'.format(100000000 + i)
+  if name == 'Biobank ID':
+    return 'Y{:09d}'.format(200000000 + i)
+  if name == 'First Name':
+    return r.choice(FIRST_NAMES)
+  if name == 'Last Name':
+    return r.choice(LAST_NAMES)
+  if name == 'Date of Birth':
+    return random_date(r, 1930, 1999)
+  if name == 'Street Address':
+    addr = '{} {}'.format(r.randint(1, 9999), r.choice(STREETS))
+    if r.random() < 0.2:
+      addr += r.choice([', Apt {}'.format(r.randint(1, 40)),
+                        '\nApt {}'.format(r.randint(1, 40)), ' "Rear"'])
+    return addr
+  if name == 'City':
+    return CITIES[i % len(CITIES)][0]
+  if name == 'State':
+    return CITIES[i % len(CITIES)][1]
+  if name == 'ZIP':
+    return '{:05d}'.format(r.randint(10001, 11697))
+  if name == 'Email':
+    return 'participant{}@example.com'.format(i) if r.random() < 0.8 else ''
+  if name == 'Phone':
+    return '({}) 555-{:04d}'.format(r.choice([212, 646, 718, 917]),
+                                    r.randint(0, 9999))
+  if name in CHOICES:
+    return r.choice(CHOICES[name])
+  if name.endswith('Site') or name.startswith('Paired'):
+    return r.choice(SITES)
+  if typ == 'DATE':
+    return random_date(r) if r.random() < 0.6 else ''
+  if max_len <= 2:
+    return r.choice(['0', '1', '1', ''])
+  return ''
+
+def write_workqueue(path, nrows, seed=0):
+  '''Write a Work Queue CSV of nrows data rows to path.'''
+  r = random.Random(seed)
+  cols = table_columns()
+  with open(path, 'wb') as f:
+    f.write(codecs.BOM_UTF8)
+    for row in BANNER_ROWS:
+      f.write(row + '\r\n')
+    writer = csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator='\r\n')
+    writer.writerow([name for name, _, _ in cols])
+    for i in xrange(nrows):
+      writer.writerow([unicode(value_for(r, i, *col)).encode('utf_8') 
+                       for col in cols])
+    for row in TRAILER_ROWS:
+      f.write(row + '\r\n')
+  return path
+
+if __name__ == '__main__':
+  write_workqueue(sys.argv[1], int(sys.argv[2]), 
+                  int(sys.argv[3]) if len(sys.argv) > 3 else 0)
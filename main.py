@@ -1,18 +1,30 @@
 import os # https://docs.python.org/2/library/os.path.html
 import sys 
+import atexit
+import argparse
+import errno
+import gzip
 import shutil
 import time
+import datetime
 import json
 import csv
 import codecs
-import chardet
-import pymssql
-import dateutil # dateutil.tz
-from dateutil.parser import * # parse()
-import pytz
-from watchdog.observers.polling import PollingObserver
-from watchdog.events import FileSystemEventHandler
+import hashlib
+import collections
+import heapq
+import itertools
+import contextlib
+import tempfile
+import cPickle
+import threading
+import gc
+import re
+import sqlite3
 import kickshaws as ks # logging, email
+# Heavier modules (pymssql, dateutil, pytz, watchdog, multiprocessing, and 
+# those for profiling and serving metrics) are imported in the functions that
+# use them, so that the service starts quickly; see startup checks.
 
 #-----------------------------------------------------------------------------#
 #                              healthproimporter                              #
@@ -30,35 +42,191 @@ sys.setdefaultencoding('utf-8')
 #-----------------------------------------------------------------------------
 # init
 
+# A HealthPro CSV has some extraneous (non-csv) rows at the beginning and
+# end; these are what they look like (after stripping whitespace).
+HP_CSV_FIRST_ROW = u'"This file contains information that is sensitive '\
+                   'and confidential. Do not distribute either the file or '\
+                   'its contents."'
+HP_CSV_SECOND_ROW = u'""'
+HP_CSV_PENULTIMATE_ROW = u'""'
+HP_CSV_LAST_ROW = u'"Confidential Information"'
+
+# Column that uniquely identifies a row of the HealthPro CSV.
+HP_KEY_COLUMN = 'PMI ID'
+
 # Total of [row w/ col titles] + [4 non-csv rows that HealthPro csv includes]
 HP_CSV_NONDATA_ROWCOUNT = 5
 
+# Values of char columns this narrow (e.g., the status flags) are interned,
+# so that the many repeats of each share one string object. It's the 
+# column's declared length that counts: IDs are short too, but unique.
+INTERN_MAX_CHARS = 2
+
+# Most distinct date/time values from the CSV we keep parsed results for.
+DATETIME_CACHE_MAX = 100000
+
+# Most bad values (i.e., that can't be converted to their column's type) we
+# list in the notice about them.
+BAD_VALUES_MAX_REPORTED = 20
+
+# How many bytes from the head and tail of a file the quick checks look at.
+QUICK_CHECK_BYTES = 64 * 1024
+
+# The quick rowcount check rejects a file only if its estimated rowcount is
+# well below what's in the db (the estimate is rough); the exact check comes
+# later.
+ROWCOUNT_ESTIMATE_MIN_RATIO = 0.5
+
+# A pooled db connection that's been idle longer than this (in seconds) gets
+# health-checked before it's handed out again.
+DB_IDLE_CHECK_SECS = 60
+
+# SQL Server allows at most this many rows in one insert ... values statement.
+MSSQL_MAX_VALUES_ROWS = 1000
+
+# Polling an Agent job (see agent jobs): the interval starts at 
+# JOB_POLL_MIN_SECS and grows by a factor of JOB_POLL_BACKOFF up to 
+# JOB_POLL_MAX_SECS. We keep the durations of each job's last
+# JOB_DURATIONS_KEPT runs.
+JOB_POLL_MIN_SECS = 1
+JOB_POLL_MAX_SECS = 30
+JOB_POLL_BACKOFF = 1.5
+JOB_DURATIONS_KEPT = 20
+
+# Most insert statements we keep built (see Catalog).
+INSERT_STMT_CACHE_MAX = 16
+
+# While waiting for a new file to be completely written (i.e., its size and
+# mtime to stay the same for file_ready_quiet_secs), we check every 
+# FILE_READY_POLL_SECS. See wait_for_file_ready.
+FILE_READY_POLL_SECS = 0.5
+
+# Filesystem types (as in /proc/mounts) the inbox has to be polled on, since
+# inotify doesn't see changes made to them from other machines.
+NETWORK_FS_TYPES = ('cifs', 'smbfs', 'smb3', 'nfs', 'nfs4', 'afs', 'ncpfs',
+                    'fuse.sshfs', '9p')
+
+# Most files that can be waiting to be processed at once.
+INGEST_QUEUE_MAX = 100
+
 # Create log object.
-log = ks.create_logger('hpimporter.log', 'main-logger')
+log_path = 'hpimporter.log'
+log = ks.create_logger(log_path, 'main-logger')
+log_dir = os.path.dirname(os.path.abspath(log_path))
 
 # Load configuration info from config file.
 config_fname = 'enclave/healthproimporter_config.json'
 cfg = {}
 with open(config_fname, 'r') as f: cfg = json.load(f)
-consortium_tag = cfg['consortium_tag']
-inbox_dir = cfg['inbox_dir']
-archive_dir = cfg['archive_dir']
 db_info = cfg['db_info']
-healthpro_table_name = cfg['healthpro_table_name'] 
-metadata_table_name = cfg['metadata_table_name']
-redcap_table_name = cfg['redcap_table_name']
-redcap_job_name = cfg['redcap_job_name']
 from_email = cfg['from_email'] 
 to_email = cfg['to_email'] 
-agent_job_timeout = cfg['agent_job_timeout']
+# Optional settings.
+db_backend = cfg.get('db_backend', 'mssql') # Or 'standin'; see standin.py.
+db_pool_size = cfg.get('db_pool_size', 4)
+insert_batch_size = cfg.get('insert_batch_size', 500) # Rows per round trip.
+file_ready_timeout = cfg.get('file_ready_timeout', 600) # Seconds.
+file_ready_quiet_secs = cfg.get('file_ready_quiet_secs', 2) # Seconds.
+coalesce_secs = cfg.get('coalesce_secs', 0) # See IngestQueue.
+ingest_workers = cfg.get('ingest_workers') # Default: one per pipeline.
+notify_backend = cfg.get('notify_backend', 'email') # Or 'file'; see 
+                                                    # notifications.
+notify_file_path = cfg.get('notify_file_path', 'notifications.log')
+notify_min_interval_secs = cfg.get('notify_min_interval_secs', 60)
+parallel_chunk_bytes = cfg.get('parallel_chunk_bytes', 16 * 1024 * 1024)
+inbox_watcher = cfg.get('inbox_watcher', 'auto') # Or 'native' or 'polling';
+                                                 # see make_observer.
+rowcount_mode = cfg.get('rowcount_mode', 'stats') # Or 'exact'; see 
+                                                  # db_curr_rowcount.
+profile_every = cfg.get('profile_every', 0) # See profiling.
+sort_spill_dir = cfg.get('sort_spill_dir') # See sorted loads.
+startup_check_timeout = cfg.get('startup_check_timeout', 30) # Seconds.
+# See metrics.
+metrics_textfile = cfg.get('metrics_textfile')
+metrics_host = cfg.get('metrics_host', '127.0.0.1')
+metrics_port = cfg.get('metrics_port')
+
+class Pipeline(object):
+  '''One feed of HealthPro CSVs: the inbox they're deposited in, and the 
+  tables they (and the REDCap data that goes with them) are loaded into.
+  defn is a map of settings (an item of 'pipelines' in the config file);
+  any that aren't in it are taken from the top level of the config file.'''
+
+  def __init__(self, defn, only_one):
+    def setting(key, *default):
+      if key in defn:
+        return defn[key]
+      if key in cfg or not default:
+        return cfg[key]
+      return default[0]
+    self.consortium_tag = setting('consortium_tag')
+    self.name = setting('name', self.consortium_tag)
+    self.inbox_dir = setting('inbox_dir')
+    self.archive_dir = setting('archive_dir')
+    self.healthpro_table_name = setting('healthpro_table_name')
+    self.metadata_table_name = setting('metadata_table_name')
+    self.redcap_table_name = setting('redcap_table_name')
+    self.redcap_job_name = setting('redcap_job_name')
+    self.agent_job_timeout = setting('agent_job_timeout')
+    # Optional settings.
+    self.load_mode = setting('load_mode', 'full') # Or 'delta'; see delta 
+                                                  # loads.
+    self.delta_snapshot_path = setting('delta_snapshot_path',
+        'enclave/healthpro_snapshot.sqlite' if only_one 
+        else 'enclave/{}_snapshot.sqlite'.format(self.name))
+    # Staging tables; see db_switch_in.
+    self.healthpro_staging_table_name = setting('healthpro_staging_table_name',
+                                                None)
+    self.redcap_staging_table_name = setting('redcap_staging_table_name', 
+                                             None)
+    # Start the REDCap refresh as soon as the file passes the quick checks,
+    # rather than once it's loaded; see process_file.
+    self.concurrent_redcap_refresh = setting('concurrent_redcap_refresh', 
+                                             False)
+    self.parallel_workers = setting('parallel_workers', 1) # See parallel 
+                                                           # loads.
+    # See sorted loads.
+    self.sort_key = setting('sort_key', None)
+    self.suspend_indexes = setting('suspend_indexes', [])
+    self.ingest_index_path = setting('ingest_index_path', 
+        os.path.join(self.archive_dir, 'index.jsonl'))
+    # Or 'when_copying' or 'always'; see archive.
+    self.archive_compression = setting('archive_compression', 'none')
+    self._ingest_index = None
+    self._ingest_index_lock = threading.Lock()
 
-# Flag to indicate monitored folder is gone. 
-inbox_gone_flag = False
+  @property
+  def ingest_index(self):
+    '''See archive. Read in on first use, rather than at startup, since the
+    archive may be on a slow (or, for the moment, unreachable) mount.'''
+    with self._ingest_index_lock:
+      if self._ingest_index is None:
+        self._ingest_index = IngestIndex(self.ingest_index_path)
+      return self._ingest_index
+
+  def tables(self):
+    return [self.healthpro_table_name, self.healthpro_staging_table_name,
+            self.metadata_table_name, self.redcap_table_name,
+            self.redcap_staging_table_name]
+
+# Without a 'pipelines' list, the top level of the config file defines the 
+# one pipeline.
+pipeline_defns = cfg.get('pipelines', [{}])
+pipelines = [Pipeline(x, len(pipeline_defns) == 1) for x in pipeline_defns]
 
 # Some specific errors we want log/email differently.
 class AgentJobThresholdException(Exception):
   pass
 
+class DeltaSnapshotException(Exception):
+  '''The delta snapshot turned out to be out of step with the table.'''
+  pass
+
+class CsvRejectedException(Exception):
+  '''The deposited file turned out to be bad while it was being loaded.
+  The message is the notice to send.'''
+  pass
+
 #------------------------------------------------------------------------------
 # general utils
 
@@ -73,6 +241,42 @@ def slurp(pth):
     out = f.read()
   return out
 
+def peek(iterable):
+  '''Returns a tuple of (first item or None if empty, iterator over all of
+  the items, including the first).'''
+  it = iter(iterable)
+  first = next(it, None)
+  return first, (it if first is None else itertools.chain([first], it))
+
+class BackgroundCall(object):
+  '''Calls func(*args) on a thread of its own. result() waits for it to
+  return, then returns what it returned (or raises what it raised).'''
+
+  def __init__(self, func, *args):
+    self.started = time.time()
+    self._result = None
+    self._error = None
+    self._thread = threading.Thread(target=self._run, args=(func, args))
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _run(self, func, args):
+    try:
+      self._result = func(*args)
+    except Exception, ex:
+      self._error = ex
+
+  def wait(self, timeout=None):
+    '''Waits up to timeout seconds; returns whether func has returned.'''
+    self._thread.join(timeout)
+    return not self._thread.is_alive()
+
+  def result(self):
+    self._thread.join()
+    if self._error:
+      raise self._error
+    return self._result
+
 def unadorned_table_name(table_name):
   '''Takes a fully qualified table name that uses brackets, and 
   returns just the unardorned table name by itself.
@@ -83,26 +287,365 @@ def unadorned_table_name(table_name):
   return table_name[table_name.rfind('[')+1:-1]
 
 #------------------------------------------------------------------------------
-# email
+# notifications
+# Emails to the team go through a Notifier, which sends them from a thread of
+# its own so that a slow mail server doesn't hold up ingesting. Per category
+# (success, notice, error), at most one email goes out every 
+# notify_min_interval_secs; messages that come in meanwhile are merged into
+# one digest, sent once the interval is up. 
 
-def send_success_email():
-  try:
-    ks.send_email(from_email, to_email, 'HealthPro WQ Ingest Success'
-                 , 'Success!')
-  except Exception, ex:
-    log.error('Error when trying to email: ' + str(ex))
+NOTIFY_SUBJECTS = {'success': 'HealthPro WQ Ingest Success',
+                   'notice': 'NOTIFICATION - HealthPro WQ Ingest',
+                   'error': 'HealthPro WQ Ingest ERROR'}
 
-def send_notice_email(msg):
+def email_sink(subject, body):
   try:
-    ks.send_email(from_email, to_email, 'NOTIFICATION - HealthPro WQ Ingest', msg)
+    ks.send_email(from_email, to_email, subject, body)
   except Exception, ex:
     log.error('Error when trying to email: ' + str(ex))
+
+def file_sink(subject, body):
+  '''Writes notifications to notify_file_path instead of emailing them (for
+  testing).'''
+  with open(notify_file_path, 'a') as f:
+    f.write('{} {}\n{}\n\n'.format(time.strftime('%Y-%m-%d %H:%M:%S'), 
+                                   subject, body))
+
+class Notifier(object):
+  '''See above. sink is called with the subject and body of each email.'''
+
+  def __init__(self, sink, min_interval):
+    self.sink = sink
+    self.min_interval = min_interval
+    self._pending = collections.OrderedDict() # Category -> [[msg, count]].
+    self._last_sent = {} # Category -> time.
+    self._silenced = set() # See notify's once_key.
+    self._sending = False
+    self._flushing = False
+    self._cond = threading.Condition()
+    t = threading.Thread(target=self._run, name='notifier')
+    t.daemon = True
+    t.start()
+
+  def notify(self, category, msg, once_key=None):
+    '''Queue msg to be sent. If once_key is given, further messages with
+    the same once_key are dropped until resolve(once_key) is called (e.g.,
+    for a condition that persists until it's fixed).'''
+    with self._cond:
+      if once_key:
+        if once_key in self._silenced:
+          return
+        self._silenced.add(once_key)
+      msgs = self._pending.setdefault(category, [])
+      for x in msgs:
+        if x[0] == msg:
+          x[1] += 1
+          break
+      else:
+        msgs.append([msg, 1])
+      self._cond.notify()
+
+  def resolve(self, once_key):
+    with self._cond:
+      self._silenced.discard(once_key)
+
+  def flush(self, timeout=30):
+    '''Send whatever's waiting now, regardless of the interval, and wait 
+    (up to timeout seconds) for it to go out.'''
+    deadline = time.time() + timeout
+    with self._cond:
+      self._flushing = True
+      self._cond.notify()
+      while (self._pending or self._sending) and time.time() < deadline:
+        self._cond.wait(deadline - time.time())
+      self._flushing = False
+
+  def _take_due(self):
+    '''Waits until some category is due; returns list of (category, msgs).
+    Call while holding _cond.'''
+    while True:
+      now = time.time()
+      next_due = None
+      due = []
+      for category in self._pending:
+        due_at = self._last_sent.get(category, 0) + self.min_interval
+        if self._flushing or due_at <= now:
+          due.append(category)
+        else:
+          next_due = min(next_due or due_at, due_at)
+      if due:
+        for category in due:
+          self._last_sent[category] = now
+        return [(c, self._pending.pop(c)) for c in due]
+      self._cond.wait(None if next_due is None else next_due - now)
+
+  def _run(self):
+    while True:
+      with self._cond:
+        batches = self._take_due()
+        self._sending = True
+      try:
+        for category, msgs in batches:
+          self._send(category, msgs)
+      except Exception, ex:
+        log.error('Error when trying to send notification: ' + str(ex))
+      finally:
+        with self._cond:
+          self._sending = False
+          self._cond.notify_all()
+
+  def _send(self, category, msgs):
+    subject = NOTIFY_SUBJECTS[category]
+    bodies = [msg if count == 1 else 
+              '{}\n\n(This happened {} times.)'.format(msg, count)
+              for msg, count in msgs]
+    if len(bodies) > 1:
+      subject += ' ({} messages)'.format(len(bodies))
+    self.sink(subject, '\n\n----------\n\n'.join(bodies))
+
+notifier = Notifier(file_sink if notify_backend == 'file' else email_sink,
+                    notify_min_interval_secs)
+# Send what's waiting before we exit.
+atexit.register(notifier.flush)
+
+def send_success_email(pl):
+  notifier.notify('success', 'Success!' if len(pipelines) == 1
+                             else 'Success! ({})'.format(pl.name))
+
+def send_notice_email(msg, once_key=None):
+  notifier.notify('notice', msg, once_key)
  
 def send_error_email(msg):
+  notifier.notify('error', msg)
+
+#------------------------------------------------------------------------------
+# metrics
+# Each run of process_file and of refresh_redcap_table is timed stage by 
+# stage, in a RunMetrics object, along with the bytes read, rows loaded, 
+# db calls made (round trips) and time spent in them, and the number of
+# files waiting in the ingest queue. The thread doing a run has it as 
+# metrics_local.run, so that db_run can count its calls. When a run ends 
+# it's logged and recorded in the metadata table (tag <table>-run; the 
+# details are JSON), and the latest figures are published in Prometheus' 
+# text format: written to metrics_textfile (e.g., for node_exporter's 
+# textfile collector), and served over HTTP at /metrics on metrics_port, if
+# those are set.
+
+# Outcomes of runs that don't touch the db (a duplicate file is only noted 
+# in the archive index), so aren't recorded in the metadata table either.
+METRICS_UNRECORDED_OUTCOMES = ('duplicate',)
+
+metrics_local = threading.local()
+
+class RunMetrics(object):
+  '''kind is 'healthpro' or 'redcap'. Call begin with the name of each 
+  stage as it starts; a stage runs until the next one begins, or the run
+  ends.'''
+
+  def __init__(self, pl, kind, fname=None):
+    self.pipeline_name = pl.name
+    self.kind = kind
+    self.fname = fname
+    self.metadata_table_name = pl.metadata_table_name
+    self.table_name = (pl.healthpro_table_name if kind == 'healthpro' 
+                       else pl.redcap_table_name)
+    self.started = time.time()
+    self.secs = None
+    self.outcome = None
+    self.stages = collections.OrderedDict() # Stage name -> secs.
+    self.bytes_read = 0
+    self.rows = 0
+    self.db_calls = 0
+    self.db_secs = 0.0
+    self.queue_depth = metrics_registry.queue_depth()
+    self.outer = None # See start_run.
+    self._stage = None
+    self._stage_started = None
+    self._lock = threading.Lock()
+
+  def begin(self, stage):
+    now = time.time()
+    with self._lock:
+      self._end_stage(now)
+      self._stage, self._stage_started = stage, now
+
+  def _end_stage(self, now):
+    if self._stage:
+      self.stages[self._stage] = (self.stages.get(self._stage, 0) 
+                                  + now - self._stage_started)
+    self._stage = None
+
+  def count_db_call(self, secs):
+    with self._lock:
+      self.db_calls += 1
+      self.db_secs += secs
+
+  def finish(self, outcome):
+    now = time.time()
+    with self._lock:
+      self._end_stage(now)
+      self.secs = now - self.started
+      self.outcome = outcome
+
+  def rows_per_sec(self):
+    secs = self.stages.get('load')
+    return self.rows / secs if self.rows and secs else None
+
+  def as_map(self):
+    return collections.OrderedDict([
+        ('pipeline', self.pipeline_name), ('kind', self.kind),
+        ('file', self.fname), ('outcome', self.outcome), 
+        ('started', self.started), ('secs', round(self.secs, 3)),
+        ('stages', collections.OrderedDict((k, round(v, 3)) 
+                                           for k, v in self.stages.items())),
+        ('bytes_read', self.bytes_read), ('rows', self.rows),
+        ('rows_per_sec', self.rows_per_sec() and 
+                         round(self.rows_per_sec(), 1)),
+        ('db_calls', self.db_calls), ('db_secs', round(self.db_secs, 3)),
+        ('queue_depth', self.queue_depth)])
+
+def current_run():
+  return getattr(metrics_local, 'run', None)
+
+def count_db_call(secs):
+  run = current_run()
+  if run:
+    run.count_db_call(secs)
+
+def start_run(pl, kind, fname=None):
+  '''Returns a new RunMetrics, which is this thread's current run until 
+  end_run.'''
+  run = RunMetrics(pl, kind, fname)
+  # E.g., a REDCap refresh within a HealthPro run has one outside it.
+  run.outer = current_run()
+  metrics_local.run = run
+  return run
+
+def end_run(run, outcome):
+  '''Finish the run, and log, record and publish it. Failing to record it 
+  is logged, but doesn't fail the run.'''
+  run.finish(outcome)
+  metrics_local.run = run.outer
+  details = json.dumps(run.as_map())
+  log.info('Run metrics: ' + details)
+  metrics_registry.record(run)
+  if outcome in METRICS_UNRECORDED_OUTCOMES:
+    return
   try:
-    ks.send_email(from_email, to_email, 'HealthPro WQ Ingest ERROR', msg)
+    update_metadata(run.metadata_table_name, 
+                    unadorned_table_name(run.table_name) + '-run', details)
   except Exception, ex:
-    log.error('Error when trying to email: ' + str(ex))
+    log.error('Could not record run metrics: {}'.format(ex))
+
+def prom_labels(labels):
+  def esc(v):
+    return unicode(v).replace('\\', '\\\\').replace('"', '\\"')\
+                     .replace('\n', '\\n')
+  if not labels:
+    return ''
+  return '{' + ','.join(u'{}="{}"'.format(k, esc(v)) 
+                        for k, v in labels) + '}'
+
+class MetricsRegistry(object):
+  '''The latest run of each kind for each pipeline, and counts of runs by 
+  outcome; render gives them in Prometheus' text format.'''
+
+  def __init__(self, textfile_path=None):
+    self.textfile_path = textfile_path
+    self.queue_depth_func = None # Set once there's an ingest queue.
+    self._last = {} # (pipeline name, kind) -> RunMetrics
+    self._run_counts = collections.Counter() # (pipeline, kind, outcome)
+    self._lock = threading.Lock()
+
+  def queue_depth(self):
+    return self.queue_depth_func() if self.queue_depth_func else None
+
+  def record(self, run):
+    with self._lock:
+      self._last[(run.pipeline_name, run.kind)] = run
+      self._run_counts[(run.pipeline_name, run.kind, run.outcome)] += 1
+    if self.textfile_path:
+      try:
+        self.write_textfile()
+      except Exception, ex:
+        log.error('Could not write metrics file: {}'.format(ex))
+
+  def render(self):
+    out = []
+    def metric(name, typ, help, samples):
+      out.append('# HELP ingester_{} {}'.format(name, help))
+      out.append('# TYPE ingester_{} {}'.format(name, typ))
+      for labels, value in samples:
+        if value is not None:
+          out.append(u'ingester_{}{} {}'.format(name, prom_labels(labels), 
+                                                value))
+    with self._lock:
+      runs = sorted(self._last.items())
+      counts = sorted(self._run_counts.items())
+    def per_run(get):
+      return [((('pipeline', p), ('kind', k)), get(run)) 
+              for (p, k), run in runs]
+    metric('runs_total', 'counter', 'Runs, by outcome.',
+           [((('pipeline', p), ('kind', k), ('outcome', o)), n)
+            for (p, k, o), n in counts])
+    metric('last_run_timestamp_seconds', 'gauge', 
+           'When the last run started.', per_run(lambda r: r.started))
+    metric('last_run_seconds', 'gauge', 'How long the last run took.',
+           per_run(lambda r: r.secs))
+    metric('last_run_stage_seconds', 'gauge', 
+           'How long each stage of the last run took.',
+           [((('pipeline', p), ('kind', k), ('stage', s)), secs)
+            for (p, k), run in runs for s, secs in run.stages.items()])
+    metric('last_run_bytes_read', 'gauge', 
+           'Bytes of the file the last run read.', 
+           per_run(lambda r: r.bytes_read))
+    metric('last_run_rows', 'gauge', 'Rows the last run loaded.',
+           per_run(lambda r: r.rows))
+    metric('last_run_rows_per_second', 'gauge', 
+           'Rows per second of the last run\'s load stage.',
+           per_run(lambda r: r.rows_per_sec()))
+    metric('last_run_db_calls', 'gauge', 
+           'Db calls (round trips) the last run made.',
+           per_run(lambda r: r.db_calls))
+    metric('last_run_db_seconds', 'gauge', 
+           'Time the last run spent in db calls.',
+           per_run(lambda r: r.db_secs))
+    metric('queue_depth', 'gauge', 'Files waiting to be processed.',
+           [((), self.queue_depth())])
+    return u'\n'.join(out) + u'\n'
+
+  def write_textfile(self):
+    # Written to a temp file and renamed, so it's never read half-written.
+    tmp_path = self.textfile_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+      f.write(self.render().encode('utf_8'))
+    os.rename(tmp_path, self.textfile_path)
+
+metrics_registry = MetricsRegistry(metrics_textfile)
+
+def start_metrics_server(host, port):
+  '''Serve metrics over HTTP from a thread of its own.'''
+  import BaseHTTPServer
+  class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+      if self.path.split('?')[0] not in ('/metrics', '/'):
+        self.send_error(404)
+        return
+      body = metrics_registry.render().encode('utf_8')
+      self.send_response(200)
+      self.send_header('Content-Type', 'text/plain; version=0.0.4')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, format, *args):
+      pass # Scrapes would swamp the log.
+  server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+  t = threading.Thread(target=server.serve_forever, name='metrics-server')
+  t.daemon = True
+  t.start()
+  log.info('Serving metrics at http://{}:{}/metrics.'.format(host, port))
+  return server
 
 #------------------------------------------------------------------------------
 # file utils
@@ -114,142 +657,434 @@ def del_file(f):
   return True
 
 def move_file(src, dest):
-  log.info('About to copy {} to {}.'.format(src, dest))
-  shutil.copy(src, dest)
-  log.info('Copied {} to {}.'.format(src, dest))
+  '''Move src to dest (a path, or a folder to move it into). If both are on
+  the same filesystem this is just a rename; otherwise we fall back to 
+  copying and deleting.'''
+  dest_path = dest
+  if os.path.isdir(dest):
+    dest_path = os.path.join(dest, os.path.basename(src))
+  try:
+    os.rename(src, dest_path)
+    log.info('Moved {} to {}.'.format(src, dest_path))
+    return True
+  except OSError, ex:
+    if ex.errno != errno.EXDEV:
+      raise ex
+  log.info('About to copy {} to {}.'.format(src, dest_path))
+  shutil.copy(src, dest_path + '.part')
+  os.rename(dest_path + '.part', dest_path)
+  log.info('Copied {} to {}.'.format(src, dest_path))
   del_file(src)
   return True
 
+# Maps path -> (size, mtime) of each file in an inbox when it was last found
+# to be ready; so a file that changes afterwards (e.g., a network copy that
+# stalled for longer than file_ready_quiet_secs, then went on) is processed
+# again, but one that's merely re-queued isn't. A file that's (re)created
+# or deleted is forgotten. See make_handler_obj.
+ready_file_stats = {}
+
+def forget_ready_file(path):
+  ready_file_stats.pop(path, None)
+
+def wait_for_file_ready(path, timeout=None):
+  '''Wait until whatever is writing the file (e.g., a copy over the network
+  or a browser download) seems to be done with it: its size and mtime 
+  haven't changed for file_ready_quiet_secs. Returns True if so; False if
+  the file is still changing after timeout seconds (default: 
+  file_ready_timeout) or has gone away. A file that hasn't changed since 
+  it was last found ready is ready right away.'''
+  timeout = file_ready_timeout if timeout is None else timeout
+  start = time.time()
+  last_stat = None
+  quiet_since = None
+  while True:
+    try:
+      st = os.stat(path)
+    except OSError, ex:
+      log.info('Could not stat {}: {}'.format(path, ex))
+      return False
+    now = time.time()
+    curr_stat = (st.st_size, st.st_mtime)
+    if last_stat is None and ready_file_stats.get(path) == curr_stat:
+      return True
+    if curr_stat != last_stat:
+      last_stat, quiet_since = curr_stat, now
+    elif now - quiet_since >= file_ready_quiet_secs:
+      log.info('{} is ready ({} bytes; waited {:.1f} secs).'\
+               ''.format(path, st.st_size, now - start))
+      ready_file_stats[path] = curr_stat
+      return True
+    if now - start >= timeout:
+      return False
+    time.sleep(FILE_READY_POLL_SECS)
+
+def changed_since_ready(path):
+  '''False if the file at path is gone, or hasn't changed since 
+  wait_for_file_ready last found it ready.'''
+  try:
+    st = os.stat(path)
+  except OSError:
+    return False
+  return ready_file_stats.get(path) != (st.st_size, st.st_mtime)
+
+#------------------------------------------------------------------------------
+# db connections
+
+def db_connect():
+  '''Open a new connection to the configured db.'''
+  if db_backend == 'standin':
+    import standin # For testing; see standin.py.
+    return standin.StandInConnection(db_info['database'], 
+                                     db_info.get('jobs'), log)
+  import pymssql
+  return pymssql.connect(**db_info)
+
+def db_is_disconnect(ex):
+  '''Did the connection itself go bad along with this exception? db_cursor
+  health-checks the connection when a statement fails and notes the answer
+  on the exception; the exception's type doesn't tell us, since pymssql 
+  raises OperationalError for most any error from the server.'''
+  return getattr(ex, 'db_conn_broken', False)
+
+class DbPool(object):
+  '''A small pool of open db connections, shared by all the db_* functions
+  so that we're not logging into the db on every call. A connection that's
+  been idle a while gets health-checked before it's handed out again, and
+  one that's errored out is closed rather than returned to the pool.'''
+
+  def __init__(self, connect, maxsize, idle_check_secs=DB_IDLE_CHECK_SECS):
+    self.connect = connect
+    self.maxsize = maxsize
+    self.idle_check_secs = idle_check_secs
+    self._idle = [] # (conn, time last used) pairs; most recent last.
+    self._lock = threading.Lock()
+    self._slots = threading.BoundedSemaphore(maxsize)
+
+  def acquire(self):
+    '''Get a connection (blocks if maxsize connections are in use).'''
+    self._slots.acquire()
+    try:
+      while True:
+        with self._lock:
+          if not self._idle:
+            break
+          conn, last_used = self._idle.pop()
+        if (time.time() - last_used < self.idle_check_secs
+            or self.is_healthy(conn)):
+          return conn
+        log.info('Discarding stale db connection.')
+        self._close(conn)
+      return self.connect()
+    except:
+      self._slots.release()
+      raise
+
+  def release(self, conn, broken=False):
+    '''Give a connection back. If broken, it's closed instead.'''
+    try:
+      if broken:
+        self._close(conn)
+      else:
+        with self._lock:
+          self._idle.append((conn, time.time()))
+    finally:
+      self._slots.release()
+
+  def close_all(self):
+    with self._lock:
+      idle, self._idle = self._idle, []
+    for conn, _ in idle:
+      self._close(conn)
+
+  def is_healthy(self, conn):
+    try:
+      cursor = conn.cursor()
+      cursor.execute('select 1')
+      cursor.fetchall()
+      conn.rollback()
+      return True
+    except Exception:
+      return False
+
+  def _close(self, conn):
+    try:
+      conn.close()
+    except Exception:
+      pass
+
+db_pool = DbPool(db_connect, db_pool_size)
+
+# Holds the connection of the transaction (if any) a thread is in.
+db_local = threading.local()
+
+def db_in_transaction():
+  return getattr(db_local, 'conn', None) is not None
+
+def db_rollback(conn):
+  '''Roll back; returns False if that failed too (i.e., conn is bad).'''
+  try:
+    conn.rollback()
+    return True
+  except Exception, ex:
+    log.error('Rollback failed: ' + str(ex))
+    return False
+
+@contextlib.contextmanager
+def db_cursor(as_dict=False):
+  '''Yield a cursor on a pooled connection, and commit afterwards. Inside
+  db_transaction, the cursor is on the transaction's connection instead, and
+  committing is left to db_transaction.'''
+  if db_in_transaction():
+    yield db_local.conn.cursor(as_dict=as_dict)
+    return
+  conn = db_pool.acquire()
+  try:
+    yield conn.cursor(as_dict=as_dict)
+    conn.commit()
+  except Exception, ex:
+    # Was it just the statement that failed, or the connection? (See
+    # db_is_disconnect.)
+    broken = not (db_rollback(conn) and db_pool.is_healthy(conn))
+    db_pool.release(conn, broken=broken)
+    ex.db_conn_broken = broken
+    raise
+  except:
+    db_pool.release(conn, broken=not db_rollback(conn))
+    raise
+  db_pool.release(conn)
+
+@contextlib.contextmanager
+def db_transaction():
+  '''All db_* calls made by this thread inside the with-block run in one
+  transaction, which is committed at the end (or rolled back on error). 
+  Nesting just joins the outer transaction.'''
+  if db_in_transaction():
+    yield
+    return
+  conn = db_pool.acquire()
+  db_local.conn = conn
+  ok = False
+  try:
+    yield
+    conn.commit()
+    ok = True
+  finally:
+    db_local.conn = None
+    if not ok:
+      ok = db_rollback(conn)
+    db_pool.release(conn, broken=not ok)
+
+def db_run(func, as_dict=False):
+  '''Call func with a cursor (see db_cursor) and return what it returns.
+  If the connection turns out to be dead (see db_is_disconnect), retry once
+  on a fresh one (unless we're in a transaction, in which case the whole 
+  thing has to be redone). Throws.'''
+  attempts = 1 if db_in_transaction() else 2
+  for attempt in range(attempts):
+    started = time.time()
+    try:
+      with db_cursor(as_dict) as cursor:
+        return func(cursor)
+    except Exception, ex:
+      if attempt + 1 < attempts and db_is_disconnect(ex):
+        log.info('db error ({}); retrying on a new connection.'.format(ex))
+        continue
+      log.error(str(ex))
+      raise ex
+    finally:
+      count_db_call(time.time() - started) # See metrics.
+
 #------------------------------------------------------------------------------
 # db 
 
 def db_qy(qy):
   '''Run a SQL query. Returns list of maps.'''
-  try:
-    with pymssql.connect(**db_info) as conn:
-      cursor = conn.cursor(as_dict=True)
-      cursor.execute(qy)
-      return cursor.fetchall()
-  except Exception, ex:
-    log.error(str(ex))
-    raise ex
+  def run(cursor):
+    cursor.execute(qy)
+    return cursor.fetchall()
+  return db_run(run, as_dict=True)
 
 def db_stmt(stmt):
   '''Execute a SQL DDL/DML statement. Doesn't return anything. Throws.'''
-  try:
-    with pymssql.connect(**db_info) as conn:
-      cursor = conn.cursor()
-      cursor.execute(stmt)
-      conn.commit()
-  except Exception, e:
-    log.error(str(e))
-    raise e
+  db_run(lambda cursor: cursor.execute(stmt))
 
 def db_trunc_table(table_name):
   stmt = 'truncate table ' + table_name
   db_stmt(stmt) 
 
-def db_executemany(stmt, tuples):
-  '''Execute a parameterized statement for a collection of rows.
-  tuples should be a sequence of tuples (not maps). Throws.'''
-  try:
-    with pymssql.connect(**db_info) as conn:
-      cursor = conn.cursor()
-      cursor.executemany(stmt, tuples)
-      conn.commit()
-  except Exception, e:
-    log.error(str(e))
-    raise e
-
-def parameterized_insert_stmt(table_name, data):
-  '''data should be a sequence of maps.
+def db_disable_indexes(table_name, index_names):
+  for ix in index_names:
+    db_stmt('alter index [{}] on {} disable'.format(ix, table_name))
+
+def db_rebuild_indexes(table_name, index_names):
+  '''Rebuilds (and so re-enables) the indexes.'''
+  for ix in index_names:
+    log.info('Rebuilding index {} on {}.'.format(ix, table_name))
+    db_stmt('alter index [{}] on {} rebuild'.format(ix, table_name))
+
+def multirow_insert_stmt(table_name, columns, nrows):
+  '''Returns a parameterized insert statement for nrows rows at once.
   See: http://pymssql.org/en/stable/pymssql_examples.html'''
-  stmt = u''
-  try:
-    stmt = ( u''
-           + 'insert into ' + table_name
-           + ' ([' 
-           + '],['.join(data[0]) # All rows should have same keys.
-           + ']) values ('
-           + ','.join('%s' for _ in data[0])
-           + ')')
-  except Exception, ex:
-    log.error(str(ex))
-    raise ex
-  return stmt
+  row = '(' + ','.join('%s' for _ in columns) + ')'
+  return ( u''
+         + 'insert into ' + table_name
+         + ' (['
+         + '],['.join(columns)
+         + ']) values '
+         + ','.join(row for _ in range(nrows)))
 
-def db_insert_many(table_name, data):
-  '''Takes a seq of maps. Doesn't return anything. Throws.'''
-  try:
-    stmt = parameterized_insert_stmt(table_name, data) 
-    tuples = map(lambda mp: tuple([mp[k] for k in mp]), data)
-    db_executemany(stmt, tuples)
-  except Exception, ex:
-    log.error(str(ex))
-    raise ex
+def db_bulk_insert(table_name, columns, rows, batch_size=None):
+  '''Insert rows, an iterable of tuples whose values are in the same order
+  as columns. Rows are sent batch_size at a time (as multi-row inserts, or
+  via bulk copy if the db backend has it), and only the current batch is
+  held in memory. Returns number of rows inserted. Throws.'''
+  batch_size = batch_size or insert_batch_size
+  def insert_batch(cursor, batch):
+    if hasattr(cursor, 'bulk_copy'):
+      cursor.bulk_copy(table_name, columns, batch)
+      return
+    for i in range(0, len(batch), MSSQL_MAX_VALUES_ROWS):
+      chunk = batch[i:i + MSSQL_MAX_VALUES_ROWS]
+      cursor.execute(catalog.insert_stmt(table_name, columns, len(chunk)),
+                     tuple(itertools.chain.from_iterable(chunk)))
+  count = 0
+  it = iter(rows)
+  while True:
+    batch = list(itertools.islice(it, batch_size))
+    if not batch:
+      break
+    db_run(lambda cursor: insert_batch(cursor, batch))
+    count += len(batch)
+  return count
+
+def db_switch_in(staging_table_name, table_name):
+  '''Replace the rows of table_name with the rows of staging_table_name
+  (which is left empty), atomically: readers of table_name see either the
+  old rows or the new ones, never an empty or partial table. Both tables
+  must have identical columns and indexes, and be on the same filegroup. 
+  Throws; if it does, table_name is left as it was.'''
+  with db_transaction():
+    db_trunc_table(table_name)
+    db_stmt('alter table ' + staging_table_name + ' switch to ' + table_name)
 
 def db_start_job(job_name):
   '''Start a SQL Server Agent job. Returns immediately.'''
-  try:
-    with pymssql.connect(**db_info) as conn:
-      cursor = conn.cursor()
-      cursor.callproc('msdb.dbo.sp_start_job', (job_name,))
-      conn.commit()
-  except Exception, e:
-    log.error(str(e))
-    raise e
-
-def db_is_job_idle(job_name):
-  '''job_name should be a SQL Server Agent job name. Returns boolean.'''
-  result = []
-  try:
-    with pymssql.connect(**db_info) as conn:
-      cursor = conn.cursor(as_dict=True)
-      stmt = "exec msdb.dbo.sp_help_job @job_name=N'" + job_name + "'"
-      cursor.execute(stmt) 
-      result = cursor.fetchall()
-  except Exception, e:
-    log.error(str(e))
-    raise e
-  return result[0]['current_execution_status'] == 4 # 4 means idle.
-
-def db_last_run_succeeded(job_name):
-  '''job_name should be a SQL Server Agent job name. Returns boolean.'''
-  result = []
-  try:
-    with pymssql.connect(**db_info) as conn:
-      cursor = conn.cursor(as_dict=True)
-      stmt = "exec msdb.dbo.sp_help_job @job_name=N'" + job_name + "'"
-      cursor.execute(stmt) 
-      result = cursor.fetchall()
-  except Exception, e:
-    log.error(str(e))
-    raise e
-  return result[0]['last_run_outcome'] == 1 # 1 means succeeded.
+  db_run(lambda cursor: cursor.callproc('msdb.dbo.sp_start_job', (job_name,)))
 
-def db_columns_for(table_name):
-  '''Expects table_name to be fully-qualified table name with brackets.
-  Example: [foo].[dbo].[bar]. Also expects database table to have an
+def db_job_status(job_name):
+  '''job_name should be a SQL Server Agent job name. Returns a map which 
+  includes keys current_execution_status (4 means idle), last_run_outcome
+  (1 means succeeded), last_run_date, and last_run_time.'''
+  result = db_qy("exec msdb.dbo.sp_help_job @job_name=N'" + job_name + "'"
+                 ", @job_aspect=N'JOB'")
+  return result[0]
+
+def db_fetch_column_info(table_names):
+  '''Expects fully-qualified table names with brackets. Example:
+  [foo].[dbo].[bar]. Fetches the column info for all of them in one query.
+  Returns a map of table name -> list of maps (in column order) with keys
+  column_name, data_type, and character_maximum_length. Leaves out the 
   extra column named 'rid' (which is not part of the HealhPro CSV).'''
   # Get specific db and table names by themselves; needed 
   # for subsequent query.
-  just_db = table_name[1:table_name.find(']')]
-  just_table = table_name[table_name.rfind('[')+1:-1]
-  result = db_qy("select column_name from " + just_db 
-                + ".information_schema.columns" 
-                + " where table_name = N'" + just_table +"'")
-  cols = [x['column_name'] for x in result if x['column_name'] != 'rid']
-  return cols
+  just_names = lambda t: (t[1:t.find(']')], unadorned_table_name(t))
+  tables_by_db = collections.OrderedDict()
+  for t in table_names:
+    just_db, just_table = just_names(t)
+    tables_by_db.setdefault(just_db, []).append(just_table)
+  qy = ' union all '.join(
+          "select N'" + just_db + "' as db_name, table_name, column_name"
+        + ", data_type, character_maximum_length, ordinal_position"
+        + " from " + just_db + ".information_schema.columns"
+        + " where table_name in (" 
+        + ','.join("N'" + x + "'" for x in just_tables) + ")"
+        for just_db, just_tables in tables_by_db.items())
+  qy += ' order by db_name, table_name, ordinal_position'
+  lookup = dict((tuple(x.lower() for x in just_names(t)), t) 
+                for t in table_names)
+  out = dict((t, []) for t in table_names)
+  for x in db_qy(qy):
+    t = lookup.get((x['db_name'].lower(), x['table_name'].lower()))
+    if t and x['column_name'] != 'rid':
+      out[t].append(x)
+  return out
+
+#------------------------------------------------------------------------------
+# db catalog
+
+class Catalog(object):
+  '''Caches the column info of our tables (see db_fetch_column_info), and
+  the insert statements built from it. Column info for all the tables is
+  fetched in one round trip, the first time any of it is needed. Call
+  invalidate if the tables might have changed.'''
+
+  def __init__(self, table_names):
+    self.table_names = [t for t in collections.OrderedDict.fromkeys(
+                                     table_names) if t]
+    self._column_info = None
+    self._insert_stmts = {}
+    self._lock = threading.Lock()
+
+  def column_info(self, table_name):
+    with self._lock:
+      if self._column_info is None or table_name not in self._column_info:
+        if table_name not in self.table_names:
+          self.table_names.append(table_name)
+        self._column_info = db_fetch_column_info(self.table_names)
+        log.info('Fetched column info for {} tables.'\
+                 ''.format(len(self.table_names)))
+      return self._column_info[table_name]
+
+  def insert_stmt(self, table_name, columns, nrows):
+    '''See multirow_insert_stmt.'''
+    key = (table_name, tuple(columns), nrows)
+    with self._lock:
+      stmt = self._insert_stmts.get(key)
+      if stmt is None:
+        if len(self._insert_stmts) >= INSERT_STMT_CACHE_MAX:
+          self._insert_stmts.clear()
+        stmt = multirow_insert_stmt(table_name, columns, nrows)
+        self._insert_stmts[key] = stmt
+      return stmt
+
+  def invalidate(self):
+    with self._lock:
+      self._column_info = None
+      self._insert_stmts.clear()
+
+catalog = Catalog(itertools.chain.from_iterable(pl.tables() 
+                                               for pl in pipelines))
+
+def db_column_info_for(table_name):
+  '''Returns list of maps (in column order) with keys column_name, 
+  data_type, and character_maximum_length; see db_fetch_column_info.'''
+  return catalog.column_info(table_name)
+
+def db_columns_for(table_name):
+  '''See db_column_info_for. Returns list of column names.'''
+  return [x['column_name'] for x in db_column_info_for(table_name)]
 
 #------------------------------------------------------------------------------
 # startup checks
 
-def check_inbox_dir_exists():
-  return os.path.exists(inbox_dir)
+def check_pipelines_distinct():
+  '''Pipelines can't share an inbox, HealthPro table, or any of the files
+  they keep.'''
+  for attr in ['name', 'inbox_dir', 'healthpro_table_name', 
+               'delta_snapshot_path', 'ingest_index_path']:
+    values = [os.path.normpath(getattr(pl, attr)) for pl in pipelines]
+    if len(set(values)) != len(values):
+      log.error('Pipelines have the same {}.'.format(attr))
+      return False
+  return True
+
+def check_inbox_dir_exists(pl):
+  return os.path.exists(pl.inbox_dir)
 
-def check_archive_dir_exists_and_writable():
-  return (os.path.exists(archive_dir)
-          and os.access(archive_dir, os.W_OK | os.X_OK))
+def check_archive_dir_exists_and_writable(pl):
+  return (os.path.exists(pl.archive_dir)
+          and os.access(pl.archive_dir, os.W_OK | os.X_OK))
 
 def check_db_can_connect():
   qy = 'select @@Version as version'
@@ -257,18 +1092,68 @@ def check_db_can_connect():
   # rslt should be list containing one map, with key of 'version'.
   return 'version' in rslt[0]
 
-def do_startup_checks():
-  '''Log results of checks; return T/F.'''
-  checks = [check_inbox_dir_exists
-          , check_archive_dir_exists_and_writable
-          , check_db_can_connect]
-  for f in checks:
-    if f():
-      log.info('Check successful: ' + f.__name__)
+def check_sort_spill_dir():
+  '''If set, sort_spill_dir has to be a folder that's writable, and that 
+  only its owner can get into, since rows are written there (see sorted 
+  loads).'''
+  if not sort_spill_dir:
+    return True
+  try:
+    mode = os.stat(sort_spill_dir).st_mode
+  except OSError:
+    return False
+  return (os.path.isdir(sort_spill_dir) 
+          and os.access(sort_spill_dir, os.W_OK | os.X_OK)
+          and not mode & 0077)
+
+def check_sort_key_columns(pl):
+  '''The sort_key columns (if any) have to be in the HealthPro table.'''
+  columns = db_columns_for(pl.healthpro_table_name)
+  return all(c in columns for c in pl.sort_key or [])
+
+def start_startup_checks():
+  '''Start all of the checks at once, each on a thread of its own (see 
+  BackgroundCall), so that a dead mount or a slow db login only holds up 
+  the checks that depend on it. Returns list of (name, BackgroundCall, 
+  needs_db) tuples; main waits for the ones that don't need the db before
+  it starts watching, and for the rest before it starts ingesting.'''
+  checks = [(check_pipelines_distinct, (), False)
+          , (check_sort_spill_dir, (), False)]
+  for pl in pipelines:
+    checks += [(check_inbox_dir_exists, (pl,), False)
+             , (check_archive_dir_exists_and_writable, (pl,), False)]
+  checks.append((check_db_can_connect, (), True))
+  checks += [(check_sort_key_columns, (pl,), True) for pl in pipelines]
+  out = []
+  for f, args, needs_db in checks:
+    name = f.__name__ + ''.join(' [{}]'.format(pl.name) for pl in args)
+    out.append((name, BackgroundCall(f, *args), needs_db))
+  return out
+
+def wait_for_checks(checks, timeout=None):
+  '''Wait for checks started by start_startup_checks; log results; return 
+  T/F. A check that raises, or is still running timeout seconds after it
+  started (default: startup_check_timeout), fails.'''
+  if timeout is None:
+    timeout = startup_check_timeout
+  ok = True
+  for name, call, _ in checks:
+    if not call.wait(max(0, call.started + timeout - time.time())):
+      log.error('Check timed out after {} secs: {}'.format(timeout, name))
+      ok = False
+      continue
+    try:
+      passed = call.result()
+    except Exception, ex:
+      log.error('Check failed: {} ({})'.format(name, ex))
+      ok = False
+      continue
+    if passed:
+      log.info('Check successful: ' + name)
     else:
-      log.error('Check failed: ' + f.__name__)
-      return False
-  return True
+      log.error('Check failed: ' + name)
+      ok = False
+  return ok
 
 #------------------------------------------------------------------------------
 # file checks 
@@ -283,348 +1168,1976 @@ def is_sys_file(fpath):
 def is_csv(fpath):
   return fpath.endswith('.csv')
 
-def check_filename_format(fpath):
+def check_filename_format(pl, fpath):
   '''Confirm filename has the format we expect:
     - has .csv extension
     - contains consortium name we expect (from config).'''
   fname = os.path.basename(fpath)
-  x = fname.startswith('workqueue_' + consortium_tag)
+  x = fname.startswith('workqueue_' + pl.consortium_tag)
   y = is_csv(fpath)
   return (x and y)
 
-def check_char_encoding_is_utf8sig(fpath):
-  '''Confirm that the character encoding of the file is utf-8 with
-  a BOM (byte-order marker) -- in Python this is normally tagged as
-  'utf_8_sig' or 'UTF-8-SIG', etc.
-  See also: comment on function check_hp_csv_format below.'''
-  f = open(fpath, 'rb') # read as raw bytes
-  raw = f.read()
-  rslt = chardet.detect(raw)
-  enc = rslt['encoding']
-  conf = str(rslt['confidence'])
-  log.info('Detected character encoding for [{}] is [{}]; confidence: '\
-           '[{}]'.format(fpath, enc, conf))
-  return enc == 'UTF-8-SIG'
-
-def check_hp_csv_format(fpath):
+#------------------------------------------------------------------------------
+# quick checks
+# These look at just the head and tail of a file so that wrong files and
+# half-copied files are rejected before we read through the whole thing.
+# Files that pass get fully validated by HealthProCsv.
+
+FileSample = collections.namedtuple('FileSample', 'size head tail')
+
+def sample_file(fpath, nbytes=QUICK_CHECK_BYTES):
+  '''Read the first and last nbytes of a file. For a small file, head and
+  tail are the same (the whole file). Returns a FileSample.'''
+  size = os.path.getsize(fpath)
+  with open(fpath, 'rb') as f:
+    head = f.read(nbytes)
+    if size <= nbytes:
+      return FileSample(size, head, head)
+    f.seek(size - nbytes)
+    tail = f.read(nbytes)
+  return FileSample(size, head, tail)
+
+def check_char_encoding_is_utf8sig(sample):
+  '''Confirm the file starts with the BOM (byte-order marker) that
+  UTF-8-SIG files have. Every line is decoded later on by HealthProCsv.
+  See also: docstring of HealthProCsv.'''
+  return sample.head.startswith(codecs.BOM_UTF8)
+
+def check_hp_csv_format(sample):
   '''A HealthPro CSV has some extraneous lines at the beginning and end.
-  Ensure this is the case with the current file.
-  SPECIAL NOTE ON ENCODING: the HealthPro CSV is encoding as UTF-8 and also
-  starts with a BOM (byte order marker). (Btw, the easiest way to confirm this
-  is by opening the csv in vim.) The precise encoding in Python for
-  this is not utf_8 but rather utf_8_sig. 
-  For example, if you used utf-8, then the first row would have 120 chars
-  (which includes the BOM), whereas the variable first_row has only 119 chars.
-  See: https://docs.python.org/2/library/codecs.html
-  '''
-  first_row = u'"This file contains information that is sensitive '\
-              'and confidential. Do not distribute either the file or '\
-              'its contents."'
-  second_row = u'""'
-  penultimate_row = u'""'
-  last_row = u'"Confidential Information"'
-  with codecs.open(fpath, 'r', encoding='utf_8_sig') as f:
-    rows = [line.strip() for line in f]
-    a = rows[0] == first_row
-    b = rows[1] == second_row
-    c = rows[-2] == penultimate_row
-    d = rows[-1] == last_row
+  Ensure this is the case with the current file, using just its head
+  and tail.'''
+  head_lines = sample.head[len(codecs.BOM_UTF8):].split('\n')
+  # The last item of each split may be a partial line; don't rely on it
+  # unless we've got the whole file.
+  whole = sample.size <= len(sample.head)
+  tail_lines = sample.tail.splitlines()
+  if len(head_lines) < 3 or len(tail_lines) < (2 if whole else 3):
+    return False
+  decode = lambda line: line.decode('utf_8', 'replace').strip()
+  a = decode(head_lines[0]) == HP_CSV_FIRST_ROW
+  b = decode(head_lines[1]) == HP_CSV_SECOND_ROW
+  c = decode(tail_lines[-2]) == HP_CSV_PENULTIMATE_ROW
+  d = decode(tail_lines[-1]) == HP_CSV_LAST_ROW
   return (a and b and c and d)
 
-def db_curr_rowcount(table_name):
-  '''Returns int.'''
+def estimate_csv_rowcount(sample):
+  '''Estimate the number of data rows from the size of the file and the 
+  average length of the data lines in its head. Returns an int, or None
+  if the head has no complete data lines to go by.'''
+  head_lines = sample.head.split('\n')
+  if sample.size <= len(sample.head):
+    return max(sample.head.count('\n') - HP_CSV_NONDATA_ROWCOUNT, 0)
+  # The first 3 lines are the 2 extraneous rows and the row w/ col titles;
+  # the last one is probably partial.
+  preamble_len = sum(len(x) + 1 for x in head_lines[:3])
+  data_lines = head_lines[3:-1]
+  if not data_lines:
+    return None
+  avg_len = sum(len(x) + 1 for x in data_lines) / float(len(data_lines))
+  return int((sample.size - preamble_len) / avg_len) - 2
+
+def check_csv_rowcount_estimate(est_rowcount, db_rowcount):
+  '''Reject only if the estimate is way below the rows in db.'''
+  if est_rowcount is None:
+    return True
+  return est_rowcount >= db_rowcount * ROWCOUNT_ESTIMATE_MIN_RATIO
+
+#------------------------------------------------------------------------------
+# full checks
+
+def db_exact_rowcount(table_name):
+  '''Returns int. Scans the table.'''
   qy = 'select count(*) as count from ' + table_name 
   rslt = db_qy(qy)
   return rslt[0]['count']
 
-def check_csv_rowcount(fpath):
+def db_stats_rowcount(table_name):
+  '''Returns int. Reads the count SQL Server keeps in the table's partition
+  metadata (heap or clustered index only), so doesn't scan the table.'''
+  just_db = table_name[1:table_name.find(']')]
+  qy = ('select coalesce(sum(rows), 0) as count from ' + just_db 
+        + ".sys.partitions where object_id = object_id(N'" + table_name 
+        + "') and index_id in (0, 1)")
+  rslt = db_qy(qy)
+  return rslt[0]['count']
+
+def db_curr_rowcount(table_name, expected_rowcount=None):
+  '''Returns int. Unless rowcount_mode is 'exact', comes from the 
+  partition metadata (see db_stats_rowcount). That count isn't guaranteed
+  to be exact, so when verifying (i.e., expected_rowcount is given) and it
+  doesn't match, we fall back to counting the rows.'''
+  if rowcount_mode == 'exact' or db_backend == 'standin':
+    return db_exact_rowcount(table_name)
+  rowcount = db_stats_rowcount(table_name)
+  if expected_rowcount is None or rowcount == expected_rowcount:
+    return rowcount
+  log.info('Rowcount of {} per stats is {}; expected {}; counting rows.'\
+           ''.format(table_name, rowcount, expected_rowcount))
+  return db_exact_rowcount(table_name)
+
+def check_csv_rowcount(csv_rowcount, db_rowcount):
   '''Rows in CSV must be >= rows in db.'''
-  db_rowcount =  db_curr_rowcount(healthpro_table_name)
-  csv_rowcount = -1
-  with codecs.open(fpath, 'r', encoding='utf_8_sig') as f:
-    # Note: rows in f will be of type unicode.
-    csv_rowcount = sum(1 for row in f) - HP_CSV_NONDATA_ROWCOUNT
   return csv_rowcount >= db_rowcount
 
-def check_csv_column_names(data):
+def check_csv_column_names(pl, csv_cols):
   '''Column names must match what's in the database (exception being the 
-  extra column 'rid' which is not part of the CSV). Recall that data is a 
-  seq of maps.'''
-  db_cols = db_columns_for(healthpro_table_name)
-  csv_cols = data[0].keys() # Any row from data will do.
-  return set(csv_cols) == set(db_cols)
+  extra column 'rid' which is not part of the CSV). csv_cols is the
+  CSV's header row.'''
+  if set(csv_cols or []) == set(db_columns_for(pl.healthpro_table_name)):
+    return True
+  # The table may have been altered since its columns were cached.
+  catalog.invalidate()
+  return set(csv_cols or []) == set(db_columns_for(pl.healthpro_table_name))
 
 #------------------------------------------------------------------------------
 # csv handling
 
-def standardize_healthpro_csv(fname):
-  '''HealthPro CSV contains two extraneous lines at the start and end.
-  Create a temp csv with these lines removed. Returns name of temp file.'''
-  tmpfname = 'tmp' + str(ts()) + '.csv'
-  lines = []
-  with open(fname, 'r') as inn:
-    log.info('Opened ' + fname + ' for reading.')
-    lines = [line for line in inn]
-  with open(tmpfname, 'w') as out:
-    log.info('Opened ' + tmpfname + ' for writing.')
-    for i in range(len(lines)):
-      if i not in [0, 1, len(lines)-1, len(lines)-2]:
-        out.write(lines[i])
-  log.info('Successfully created ' + tmpfname) 
-  return tmpfname
-
-def csv_to_data(fname):
-  '''Returns a list of maps.'''
-  with open(fname, 'r') as f:
-    log.info('Opened ' + fname)
-    reader = csv.DictReader(f)
-    log.info('Successfully read ' + fname + ' into memory.')
-    return [row for row in reader]
+class HealthProCsv(object):
+  '''Reads a deposited HealthPro CSV in a single streaming pass.
+  Iterating over an instance yields the data rows as tuples whose values are
+  in the same order as header (see also column_index), and along the way:
+    - confirms the file starts with a BOM and that every line decodes
+      as UTF-8 (see note below);
+    - checks the extraneous rows at the beginning and end (these are
+      skipped rather than written out to a temp file);
+    - counts the data rows; and
+    - computes a SHA-1 digest of the raw bytes.
+  Iteration stops early if the encoding or format is wrong, so always check
+  encoding_ok and format_ok once iteration is over.
+  SPECIAL NOTE ON ENCODING: the HealthPro CSV is encoded as UTF-8 and also
+  starts with a BOM (byte order marker). (Btw, the easiest way to confirm this
+  is by opening the csv in vim.) The precise encoding in Python for
+  this is not utf_8 but rather utf_8_sig. 
+  For example, if you used utf-8, then the first row would have 120 chars
+  (which includes the BOM), whereas HP_CSV_FIRST_ROW has only 119 chars.
+  See: https://docs.python.org/2/library/codecs.html
+  '''
+
+  def __init__(self, fpath):
+    self.fpath = fpath
+    self.encoding_ok = True # Until proven otherwise.
+    self.format_ok = False  # Only known once we've seen the last row.
+    self.header = None # Tuple of column names, once read.
+    self.column_index = {} # Column name -> position in header & rows.
+    self.rowcount = 0
+    self.digest = None
+    self.bytes_read = 0
+
+  def _body_lines(self):
+    '''Yield the raw lines of the file minus the extraneous rows at the
+    beginning and end. The last two lines are held back until we know
+    whether they're the final two rows of the file.'''
+    sha = hashlib.sha1()
+    tail = collections.deque()
+    with open(self.fpath, 'rb') as f:
+      log.info('Opened ' + self.fpath + ' for reading.')
+      bom = f.read(len(codecs.BOM_UTF8))
+      sha.update(bom)
+      self.bytes_read += len(bom)
+      if bom != codecs.BOM_UTF8:
+        self.encoding_ok = False
+        return
+      expected_head = [HP_CSV_FIRST_ROW, HP_CSV_SECOND_ROW]
+      lineno = 0
+      for line in f:
+        sha.update(line)
+        self.bytes_read += len(line)
+        try:
+          text = line.decode('utf_8')
+        except UnicodeDecodeError:
+          self.encoding_ok = False
+          return
+        if lineno < len(expected_head):
+          if text.strip() != expected_head[lineno]:
+            return
+        else:
+          tail.append(line)
+          if len(tail) > 2:
+            yield tail.popleft()
+        lineno += 1
+      self.digest = sha.hexdigest()
+    expected_tail = [HP_CSV_PENULTIMATE_ROW, HP_CSV_LAST_ROW]
+    self.format_ok = (len(tail) == 2
+                      and [x.decode('utf_8').strip() for x in tail]
+                          == expected_tail)
+
+  def __iter__(self):
+    reader = csv.reader(self._body_lines())
+    header = next(reader, None) # The row w/ col titles.
+    if header is None:
+      return
+    self.header = tuple(header)
+    self.column_index = dict((col, i) for i, col in enumerate(header))
+    width = len(header)
+    for row in reader:
+      if not row:
+        continue # Skip blank lines, like csv.DictReader does.
+      self.rowcount += 1
+      if len(row) != width:
+        # Also like csv.DictReader: missing values are None; extras dropped.
+        row = (row + [None] * width)[:width]
+      yield tuple(row)
 
 def handle_csv(fname):
-  '''Read CSV & return data as list of maps; also moves CSV to archive 
-  folder.'''
-  tmp_fname = standardize_healthpro_csv(fname)
-  data = csv_to_data(tmp_fname)
-  del_file(tmp_fname)
-  move_file(fname, archive_dir)
-  return data
+  '''Start reading the CSV. Returns a tuple of (HealthProCsv obj, iterator
+  over the data rows). The header has been read by the time this returns;
+  the rest of the file gets read as the rows are consumed. So, check the
+  HealthProCsv obj afterwards.'''
+  csvfile = HealthProCsv(fname)
+  _, rows = peek(csvfile)
+  return csvfile, rows
 
 def datetime_from_csv_filename(path):
   'Returns a datetime object with tzinfo set to UTC.'
+  import dateutil.parser
+  import pytz
   fname = os.path.basename(path)
   # Get just the date and time from the file -- eg '20171214-203427'
   datetime_str = fname[fname.rfind('_')+1:fname.find('.csv')]
-  datetime_obj_step = parse(datetime_str) # dateutil library
+  datetime_obj_step = dateutil.parser.parse(datetime_str)
   # We'll be explicit and set timezone propery to UTC (since this is
   # what the CSV filename uses.).
   datetime_obj_final = datetime_obj_step.replace(tzinfo=pytz.utc)
   return datetime_obj_final
 
+#------------------------------------------------------------------------------
+# type conversion
+# Values from the CSV are converted here to the types of the db columns 
+# they're going into, rather than being sent as strings for SQL Server to
+# convert cell by cell. A bad value is reported with its row and column, 
+# instead of failing the whole load with a cryptic error.
+
+DATE_TYPES = ['date']
+DATETIME_TYPES = ['datetime', 'datetime2', 'smalldatetime']
+INT_TYPES = ['bigint', 'int', 'smallint', 'tinyint']
+CHAR_TYPES = ['nvarchar', 'varchar', 'nchar', 'char']
+
+# The formats HealthPro writes dates and times in (strptime doesn't need the
+# zero padding). Nothing else is taken for a date: a lenient parser would
+# fill in whatever's missing from today's date (e.g., '5' or 'Jan').
+HP_DATETIME_FORMATS = ['%m/%d/%Y', '%m/%d/%Y %H:%M', '%m/%d/%Y %H:%M:%S',
+                       '%m/%d/%Y %I:%M %p', '%m/%d/%Y %I:%M:%S %p', 
+                       '%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S']
+
+# The same dates repeat across thousands of rows, so we parse each distinct 
+# one only once. Maps string from the CSV -> datetime obj (or None).
+datetime_cache = {}
+
+def parse_datetime_cell(s):
+  '''Returns a datetime object, or None if s is blank. Memoized. Throws
+  ValueError if s isn't a date in one of HP_DATETIME_FORMATS.'''
+  try:
+    return datetime_cache[s]
+  except KeyError:
+    pass
+  dt = None
+  if s.strip():
+    for fmt in HP_DATETIME_FORMATS:
+      try:
+        dt = datetime.datetime.strptime(s.strip(), fmt)
+        break
+      except ValueError:
+        pass
+    else:
+      raise ValueError('not a date')
+  if len(datetime_cache) < DATETIME_CACHE_MAX:
+    datetime_cache[s] = dt
+  return dt
+
+def to_date(s):
+  dt = parse_datetime_cell(s)
+  return dt and dt.date()
+
+def to_int(s):
+  return int(s) if s.strip() else None
+
+def max_len_checker(max_len):
+  '''Returns a function that passes a value through if it fits in a column
+  of max_len characters, and throws ValueError otherwise.'''
+  def check(s):
+    # A value can't have more characters than bytes; only decode if needed.
+    if len(s) > max_len and len(s.decode('utf_8')) > max_len:
+      raise ValueError('longer than {} characters'.format(max_len))
+    return s
+  return check
+
+def converter_for(col_info):
+  '''Returns the conversion function for a column (a map from 
+  db_column_info_for), or None if its values can go as is.'''
+  data_type = col_info['data_type'].lower()
+  max_len = col_info['character_maximum_length']
+  if data_type in DATE_TYPES:
+    return to_date
+  if data_type in DATETIME_TYPES:
+    return parse_datetime_cell
+  if data_type in INT_TYPES:
+    return to_int
+  if data_type in CHAR_TYPES and max_len is not None and max_len > 0:
+    check = max_len_checker(max_len)
+    if max_len <= INTERN_MAX_CHARS:
+      return lambda s: intern(check(s))
+    return check
+  return None
+
+class RowConverter(object):
+  '''Converts rows from the CSV to the types of the db columns given by
+  column_info (see db_column_info_for). Bad values are recorded in errors
+  as (row number, column name, value, problem) tuples.'''
+
+  def __init__(self, columns, column_info):
+    info = dict((x['column_name'], x) for x in column_info)
+    self.columns = columns
+    self.column_info = column_info
+    # (position, conversion function) for each column that needs converting.
+    self.conversions = [(i, converter_for(info[col]))
+                        for i, col in enumerate(columns) if col in info]
+    self.conversions = [(i, f) for i, f in self.conversions if f]
+    self.errors = []
+    self.error_count = 0
+
+  def convert(self, rownum, row):
+    '''Returns the converted row; bad values become None.'''
+    row = list(row)
+    for i, f in self.conversions:
+      if row[i] is None:
+        continue
+      try:
+        row[i] = f(row[i])
+      except ValueError, ex:
+        self.error_count += 1
+        if len(self.errors) < BAD_VALUES_MAX_REPORTED:
+          self.errors.append((rownum, self.columns[i], row[i], str(ex)))
+        row[i] = None
+    return tuple(row)
+
+  def convert_rows(self, rows):
+    '''Generator of converted rows. Once a bad value turns up, it stops 
+    yielding (so nothing more gets written to the db) but keeps reading
+    rows so all the bad values get reported.'''
+    for rownum, row in enumerate(rows, 1):
+      row = self.convert(rownum, row)
+      if not self.error_count:
+        yield row
+
+  def notice(self, fname):
+    '''Text of notice about the bad values.'''
+    lines = ['Row {}, column [{}]: {!r} ({})'.format(*x) for x in self.errors]
+    if self.error_count > len(self.errors):
+      lines.append('... and {} more.'.format(self.error_count 
+                                              - len(self.errors)))
+    return BAD_VALUES_NOTICE.format(fname) + '\n\n' + '\n'.join(lines)
+
+#------------------------------------------------------------------------------
+# sorted loads
+# With a pipeline's sort_key set (a list of column names), the rows of a full
+# load are inserted in order of those columns, so rids (and pages) follow 
+# that order too. The rows are converted patient data, so by default they're
+# sorted in memory. Only if sort_spill_dir is set (to a folder only the 
+# ingester's account can get into; see check_sort_spill_dir) is sorting done
+# a run of SORT_RUN_ROWS rows at a time, with the sorted runs written to temp
+# files there and merged, so memory use stays bounded however big the file 
+# is.
+# With suspend_indexes set (a list of index names), those indexes on the 
+# table being loaded are disabled for the load and rebuilt once afterwards,
+# rather than being updated row by row. See 
+# sql/create-healthpro-indexes.sql.
+
+SORT_RUN_ROWS = 100000
+
+def sort_key_positions(columns, sort_key):
+  '''Positions in columns of the sort_key columns. Throws if one's 
+  missing.'''
+  missing = [c for c in sort_key if c not in columns]
+  if missing:
+    raise Exception('Sort key column(s) not found: {}'.format(missing))
+  return [columns.index(c) for c in sort_key]
+
+def write_run(rows):
+  '''Write rows to a temp file in sort_spill_dir (deleted once closed); 
+  returns it, rewound.'''
+  f = tempfile.TemporaryFile(dir=sort_spill_dir)
+  for row in rows:
+    cPickle.dump(row, f, cPickle.HIGHEST_PROTOCOL)
+  f.seek(0)
+  return f
+
+def read_run(f):
+  while True:
+    try:
+      yield cPickle.load(f)
+    except EOFError:
+      return
+
+def sorted_rows(rows, key_positions, run_rows=None):
+  '''Generator of rows sorted by the values at key_positions (a stable 
+  sort; None sorts first). In memory, unless sort_spill_dir is set; then in
+  runs of run_rows (default: SORT_RUN_ROWS).'''
+  run_rows = run_rows or SORT_RUN_ROWS
+  # (Dates can't be compared with None, hence the flag.)
+  key = lambda row: tuple((row[i] is not None, row[i]) for i in key_positions)
+  runs = []
+  run = []
+  for row in rows:
+    run.append(row)
+    if sort_spill_dir and len(run) >= run_rows:
+      run.sort(key=key)
+      runs.append(write_run(run))
+      run = []
+  run.sort(key=key)
+  if not runs:
+    for row in run:
+      yield row
+    return
+  runs.append(write_run(run))
+  run = None
+  log.info('Merging {} sorted runs.'.format(len(runs)))
+  def decorated(i, f):
+    # Run and row numbers break ties, so rows never get compared.
+    for n, row in enumerate(read_run(f)):
+      yield (key(row), i, n), row
+  try:
+    for _, row in heapq.merge(*[decorated(i, f) 
+                                for i, f in enumerate(runs)]):
+      yield row
+  finally:
+    for f in runs:
+      f.close()
+
+#------------------------------------------------------------------------------
+# delta loads
+# In delta mode (load_mode of 'delta' in the config file), rather than 
+# truncating and reloading the HealthPro table, we apply just the rows that
+# were inserted, updated, or withdrawn since the last ingest. To know what
+# changed, we keep an on-disk snapshot of the last ingested CSV: a SQLite file
+# mapping each row's key ([PMI ID]) to a digest of the row. The snapshot is
+# committed only after the db transaction is; if it's missing or suspect, the
+# next ingest does a full reload (and starts a new snapshot). Since the 
+# process could die between the two commits, leaving the snapshot behind the
+# table, a new or changed row's key is always deleted before the row is 
+# inserted, and the table's rowcount is checked before the transaction is
+# committed.
+
+DeltaCounts = collections.namedtuple('DeltaCounts',
+                                     'inserted updated withdrawn')
+
+class DeltaSnapshot(object):
+  '''Keyed snapshot of the last ingested CSV. If the snapshot file doesn't
+  exist yet (or belongs to another table), is_new is True.'''
+
+  def __init__(self, path, table_name):
+    self.path = path
+    self._db = sqlite3.connect(path)
+    self._db.text_factory = str
+    self._db.execute('create table if not exists snapshot ('
+                     'key text primary key, digest text not null)')
+    self._db.execute('create table if not exists snapshot_info ('
+                     'table_name text not null)')
+    # Keys in the CSV being ingested; used to find withdrawn rows.
+    self._db.execute('create temp table seen (key text primary key)')
+    info = self._db.execute('select table_name from snapshot_info').fetchone()
+    self.is_new = info is None or info[0] != table_name
+    if self.is_new:
+      self._db.execute('delete from snapshot')
+      self._db.execute('delete from snapshot_info')
+      self._db.execute('insert into snapshot_info values (?)', (table_name,))
+
+  def update(self, key, digest):
+    '''Record a row of the current CSV. Returns 'inserted' or 'updated' if
+    the row is new or has changed since the last snapshot; else None.'''
+    try:
+      self._db.execute('insert into seen values (?)', (key,))
+    except sqlite3.IntegrityError:
+      raise CsvRejectedException('The deposited CSV has more than one row '\
+          'with a [{}] of [{}]; so, it was not processed. Please check.'\
+          ''.format(HP_KEY_COLUMN, key))
+    row = self._db.execute('select digest from snapshot where key = ?',
+                           (key,)).fetchone()
+    if row is None:
+      self._db.execute('insert into snapshot values (?,?)', (key, digest))
+      return 'inserted'
+    if row[0] != digest:
+      self._db.execute('update snapshot set digest = ? where key = ?',
+                       (digest, key))
+      return 'updated'
+    return None
+
+  def pop_withdrawn_keys(self):
+    '''Remove and return the keys that aren't in the current CSV.'''
+    unseen = 'from snapshot where key not in (select key from seen)'
+    keys = [r[0] for r in self._db.execute('select key ' + unseen)]
+    self._db.execute('delete ' + unseen)
+    return keys
+
+  def commit(self):
+    self._db.commit()
+
+  def close(self):
+    '''Closes the file; anything not committed is rolled back.'''
+    self._db.close()
+
+def discard_delta_snapshot(delta_snapshot_path):
+  '''Delete the snapshot so the next delta ingest does a full reload.'''
+  if os.path.exists(delta_snapshot_path):
+    del_file(delta_snapshot_path)
+
+def row_digest(row):
+  return hashlib.sha1('\x1f'.join('' if v is None else str(v)
+                                  for v in row)).hexdigest()
+
+def db_delete_keys(table_name, key_column, keys):
+  '''Delete the rows whose key_column value is in keys. Throws.'''
+  for i in range(0, len(keys), MSSQL_MAX_VALUES_ROWS):
+    chunk = tuple(keys[i:i + MSSQL_MAX_VALUES_ROWS])
+    stmt = ('delete from ' + table_name + ' where [' + key_column + '] in ('
+            + ','.join('%s' for _ in chunk) + ')')
+    db_run(lambda cursor: cursor.execute(stmt, chunk))
+
+def load_delta_into_db(table_name, columns, rows, snapshot):
+  '''Apply the differences between rows and the snapshot to table_name, in 
+  one transaction. An updated row is deleted and reinserted. rows is an 
+  iterable of tuples whose values are in the same order as columns. If the
+  snapshot is new, the table is truncated first (i.e., a full reload). 
+  Updates the snapshot, but doesn't commit it. If the table doesn't end up
+  with one row per row of rows, throws (so nothing is committed). Returns 
+  DeltaCounts.'''
+  key_idx = columns.index(HP_KEY_COLUMN)
+  counts = collections.Counter()
+  pending = [] # Rows to insert.
+  # Keys of the rows to insert, whose old rows (if any) need deleting first.
+  # Even a row new since the snapshot may already be in the table, if the 
+  # last ingest's snapshot wasn't saved.
+  stale_keys = []
+  def flush():
+    db_delete_keys(table_name, HP_KEY_COLUMN, stale_keys)
+    db_bulk_insert(table_name, columns, pending)
+    del stale_keys[:]
+    del pending[:]
+  with db_transaction():
+    if snapshot.is_new:
+      log.info('No usable delta snapshot; doing a full reload.')
+      db_trunc_table(table_name)
+    nrows = 0
+    for row in rows:
+      nrows += 1
+      status = snapshot.update(row[key_idx], row_digest(row))
+      if status is None:
+        continue
+      counts[status] += 1
+      pending.append(row)
+      if not snapshot.is_new:
+        stale_keys.append(row[key_idx])
+      if len(pending) >= insert_batch_size:
+        flush()
+    flush()
+    withdrawn = snapshot.pop_withdrawn_keys()
+    db_delete_keys(table_name, HP_KEY_COLUMN, withdrawn)
+    db_rowcount = db_curr_rowcount(table_name, nrows)
+    if db_rowcount != nrows:
+      raise DeltaSnapshotException('Delta load would leave {} with {} '\
+          'rows, rather than {}; the snapshot must be out of step with '\
+          'the table. Rolled back.'.format(table_name, db_rowcount, nrows))
+  return DeltaCounts(counts['inserted'], counts['updated'], len(withdrawn))
+
+#------------------------------------------------------------------------------
+# parallel loads
+# Opt-in (a pipeline's parallel_workers > 1), for full loads into a staging
+# table without a sort_key (the rows go in in file order). The data rows of
+# the CSV are split into chunks of about parallel_chunk_bytes, each ending
+# at a record boundary (a newline that's not inside a quoted value; values
+# can contain newlines). A pool of worker processes then goes over the 
+# chunks twice: first just counting each chunk's rows, so we know what row
+# number (and rid) each chunk starts at; then parsing, converting, and 
+# inserting its rows, each worker over its own db connection. Rows get the 
+# same rids they'd get from a serial load (set explicitly, with 
+# identity_insert on), so the result is the same.
+
+# Bytes read at a time while looking for record boundaries.
+PARALLEL_SCAN_BYTES = 1024 * 1024
+
+def last_lines_start(buf, n, buf_at_line_start):
+  '''Offset in buf at which its last n lines start (splitting lines the way
+  iterating over a file does), or None if buf doesn't hold all of them.'''
+  end = len(buf) - 1 if buf.endswith('\n') else len(buf)
+  for i in range(n):
+    end = buf.rfind('\n', 0, end)
+    if end < 0:
+      return 0 if buf_at_line_start and i == n - 1 else None
+  return end + 1
+
+def record_boundaries(f, start, end, chunk_bytes):
+  '''Returns list of offsets at which to split the bytes of file f between
+  start and end into chunks of about chunk_bytes; starts with start. Each
+  offset is just past a newline with an even number of quote chars between
+  it and the previous offset.'''
+  starts = [start]
+  while starts[-1] + chunk_bytes < end:
+    quotes = 0
+    pos = starts[-1]
+    f.seek(pos)
+    found = None
+    while found is None and pos < end:
+      buf = f.read(min(PARALLEL_SCAN_BYTES, end - pos))
+      # Skip ahead to about chunk_bytes in, just counting quotes.
+      i = max(min(starts[-1] + chunk_bytes - pos, len(buf)), 0)
+      quotes += buf.count('"', 0, i)
+      while True:
+        nl = buf.find('\n', i)
+        if nl < 0:
+          quotes += buf.count('"', i)
+          break
+        quotes += buf.count('"', i, nl)
+        if quotes % 2 == 0:
+          found = pos + nl + 1
+          break
+        i = nl + 1
+      pos += len(buf)
+    if found is None or found >= end:
+      break
+    starts.append(found)
+  return starts
+
+def split_csv_body(fpath, chunk_bytes):
+  '''Checks the beginning and end of the file (as HealthProCsv does) and
+  splits the data rows into chunks. Returns tuple of (encoding ok, format 
+  ok, list of (start, end) byte offsets of the chunks).'''
+  size = os.path.getsize(fpath)
+  with open(fpath, 'rb') as f:
+    if f.read(len(codecs.BOM_UTF8)) != codecs.BOM_UTF8:
+      return False, False, []
+    # The 2 extraneous rows, and the row w/ col titles.
+    head = [f.readline() for _ in range(3)]
+    body_start = f.tell()
+    tail_pos = max(size - QUICK_CHECK_BYTES, body_start)
+    f.seek(tail_pos)
+    tail_buf = f.read()
+    i = last_lines_start(tail_buf, 2, tail_pos == body_start)
+    if i is None:
+      return True, False, []
+    tail = tail_buf[i:].split('\n')[:2] # Ignore what's after a trailing \n.
+    try:
+      head_text = [x.decode('utf_8').strip() for x in head]
+      tail_text = [x.decode('utf_8').strip() for x in tail]
+    except UnicodeDecodeError:
+      return False, False, []
+    if (head_text[:2] != [HP_CSV_FIRST_ROW, HP_CSV_SECOND_ROW]
+        or tail_text != [HP_CSV_PENULTIMATE_ROW, HP_CSV_LAST_ROW]):
+      return True, False, []
+    body_end = tail_pos + i
+    starts = record_boundaries(f, body_start, body_end, chunk_bytes)
+  return True, True, zip(starts, starts[1:] + [body_end])
+
+def chunk_lines(fpath, start, end):
+  '''Generator of the lines of the file between byte offsets start and end
+  (which should be at the start of a line, and the end of one). Raises
+  UnicodeDecodeError at a line that isn't valid UTF-8.'''
+  with open(fpath, 'rb') as f:
+    f.seek(start)
+    remaining = end - start
+    while remaining > 0:
+      line = f.readline(remaining)
+      if not line:
+        break
+      remaining -= len(line)
+      line.decode('utf_8')
+      yield line
+
+def parallel_worker_init():
+  '''Runs in each worker process when it starts. The db connections (and 
+  locks) it inherited from the ingester process mustn't be used (or 
+  closed) here, so we start over with our own.'''
+  global db_pool, db_local, catalog
+  inherited.append((db_pool, db_local, catalog))
+  db_pool = DbPool(db_connect, 1)
+  db_local = threading.local()
+  catalog = Catalog(catalog.table_names)
+  for h in log.handlers:
+    h.createLock()
+
+# See parallel_worker_init. Kept so they're never garbage-collected.
+inherited = []
+
+def count_chunk_rows(args):
+  '''Worker, first go. Returns (rowcount, whether the encoding is ok, 
+  whether each row had the same number of values as the header).'''
+  fpath, start, end, width = args
+  rowcount = 0
+  widths_ok = True
+  try:
+    for row in csv.reader(chunk_lines(fpath, start, end)):
+      if not row:
+        continue # Skip blank lines, as HealthProCsv does.
+      rowcount += 1
+      widths_ok = widths_ok and len(row) == width
+  except UnicodeDecodeError:
+    return rowcount, False, widths_ok
+  return rowcount, True, widths_ok
+
+def load_chunk(args):
+  '''Worker, second go. Returns (error_count, errors) (see RowConverter).'''
+  (fpath, start, end, table_name, columns, column_info, first_rownum,
+   first_rid, rid_incr) = args
+  converter = RowConverter(columns, column_info)
+  def rows():
+    rownum = first_rownum
+    for row in csv.reader(chunk_lines(fpath, start, end)):
+      if not row:
+        continue
+      rid = first_rid + (rownum - first_rownum) * rid_incr
+      yield (rid,) + converter.convert(rownum, row)
+      rownum += 1
+  with db_transaction():
+    db_stmt('set identity_insert ' + table_name + ' on')
+    db_bulk_insert(table_name, ('rid',) + tuple(columns), rows())
+    db_stmt('set identity_insert ' + table_name + ' off')
+  return converter.error_count, converter.errors
+
+def db_identity(table_name):
+  '''Returns tuple of (seed, increment) of the table's identity column.'''
+  if db_backend == 'standin':
+    return 1, 1
+  rslt = db_qy("select ident_seed(N'" + table_name + "') as seed"
+               ", ident_incr(N'" + table_name + "') as incr")
+  return int(rslt[0]['seed']), int(rslt[0]['incr'])
+
+def load_data_in_parallel(csvfile, table_name, converter, nworkers,
+                          suspend_indexes=()):
+  '''Load the CSV into table_name (a staging table) as described above, 
+  with nworkers worker processes. The indexes named in suspend_indexes are
+  disabled during the load and rebuilt after it, even if it fails (see 
+  sorted loads). Afterwards csvfile and converter are as they'd be after a
+  serial load.
+  Returns False, having loaded nothing, if the file couldn't be split up 
+  reliably; in that case, load it serially.'''
+  fpath = csvfile.fpath
+  encoding_ok, format_ok, chunks = split_csv_body(fpath, parallel_chunk_bytes)
+  csvfile.digest = file_digest(fpath)
+  csvfile.encoding_ok, csvfile.format_ok = encoding_ok, format_ok
+  if not (encoding_ok and format_ok):
+    return True
+  log.info('Loading {} chunks with {} workers.'.format(len(chunks), 
+                                                       nworkers))
+  width = len(csvfile.header)
+  import multiprocessing
+  pool = multiprocessing.Pool(nworkers, parallel_worker_init)
+  indexes_disabled = False
+  try:
+    counts = pool.map(count_chunk_rows, 
+                      [(fpath, start, end, width) for start, end in chunks])
+    csvfile.encoding_ok = all(x[1] for x in counts)
+    if not csvfile.encoding_ok:
+      return True
+    if not all(x[2] for x in counts):
+      # Most likely a chunk boundary fell inside a quoted value (e.g., due
+      # to a stray quote char), which would throw the rows off.
+      log.info('Rows of uneven width; not loading in parallel.')
+      return False
+    csvfile.rowcount = sum(x[0] for x in counts)
+    seed, incr = db_identity(table_name)
+    db_trunc_table(table_name)
+    indexes_disabled = True
+    db_disable_indexes(table_name, suspend_indexes)
+    tasks = []
+    rownum = 1
+    for (start, end), (rowcount, _, _) in zip(chunks, counts):
+      tasks.append((fpath, start, end, table_name, csvfile.header,
+                    converter.column_info, rownum, 
+                    seed + (rownum - 1) * incr, incr))
+      rownum += rowcount
+    results = pool.map(load_chunk, tasks)
+  finally:
+    pool.terminate()
+    pool.join()
+    if indexes_disabled:
+      db_rebuild_indexes(table_name, suspend_indexes)
+  # Digest, count, and load passes.
+  csvfile.bytes_read = 3 * os.path.getsize(fpath)
+  # Errors are in row order within each chunk, so these are the first ones.
+  converter.error_count = sum(x[0] for x in results)
+  converter.errors = list(itertools.chain.from_iterable(x[1] for x in results))
+  converter.errors = converter.errors[:BAD_VALUES_MAX_REPORTED]
+  return True
+
+#------------------------------------------------------------------------------
+# archive
+# Processed files are moved into their pipeline's archive folder: renamed, if
+# the inbox is on the same filesystem, or else copied. With the pipeline's
+# archive_compression setting, a file that has to be copied anyway 
+# ('when_copying') or every file ('always') is instead gzipped into the 
+# archive as it's read, which also gives us its digest in the same pass.
+# The archive folder has an index (see IngestIndex) of what's in it, kept as
+# a JSON Lines file: one entry per archived file, with its original name, the
+# snapshot date and time from its filename, its digest and rowcount, and 
+# what became of it (status). Each archived file also gets a sidecar with its
+# digest (<archived name>.sha1). The ingested entries are how a file 
+# identical to one already ingested is recognized (and not loaded again).
+
+# What became of an archived file.
+ARCHIVE_STATUSES = ('ingested', 'duplicate', 'superseded', 'rejected')
+
+# Compression level for gzipped archives (1 is fastest, 9 smallest).
+ARCHIVE_GZIP_LEVEL = 6
+
+def quick_key(sample):
+  '''A cheap stand-in for a file's digest, from its size and its head and
+  tail (see sample_file): files with different quick keys can't be the 
+  same.'''
+  return '{}:{}'.format(sample.size, 
+                        hashlib.sha1(sample.head + sample.tail).hexdigest())
+
+def file_digest(fpath):
+  '''SHA-1 digest of the whole file (same as HealthProCsv.digest).'''
+  sha = hashlib.sha1()
+  with open(fpath, 'rb') as f:
+    for chunk in iter(lambda: f.read(1024 * 1024), ''):
+      sha.update(chunk)
+  return sha.hexdigest()
+
+def write_digest_sidecar(archived_path, digest, fname):
+  '''fname is the file's original name (the digest is of its contents 
+  before any compression).'''
+  with open(archived_path + '.sha1', 'w') as f:
+    f.write('{}  {}\n'.format(digest, fname))
+
+def gzip_file(src, dest_path):
+  '''Write a gzipped copy of src to dest_path, reading src just once.
+  Returns src's digest.'''
+  sha = hashlib.sha1()
+  tmp_path = dest_path + '.part'
+  with open(src, 'rb') as f:
+    with contextlib.closing(gzip.GzipFile(tmp_path, 'wb', 
+                                          ARCHIVE_GZIP_LEVEL)) as gz:
+      for chunk in iter(lambda: f.read(1024 * 1024), ''):
+        sha.update(chunk)
+        gz.write(chunk)
+  os.rename(tmp_path, dest_path)
+  return sha.hexdigest()
+
+def unused_archive_path(archive_dir, name):
+  '''Path in archive_dir for name, numbered (e.g., x~1.csv) if there's 
+  already a file by that name, so nothing archived gets overwritten.'''
+  stem, ext = name, ''
+  for e in ['.csv.gz', '.csv']:
+    if name.endswith(e):
+      stem, ext = name[:-len(e)], e
+      break
+  path = os.path.join(archive_dir, name)
+  i = 0
+  while os.path.exists(path):
+    i += 1
+    path = os.path.join(archive_dir, '{}~{}{}'.format(stem, i, ext))
+  return path
+
+def same_filesystem(path_a, path_b):
+  return os.stat(path_a).st_dev == os.stat(path_b).st_dev
+
+def snapshot_str(fname):
+  '''The date and time in a HealthPro CSV's filename (ISO format, UTC), or 
+  None if it hasn't got one.'''
+  try:
+    return datetime_from_csv_filename(fname).isoformat()
+  except Exception:
+    return None
+
+class IngestIndex(object):
+  '''See above. Entries are maps with keys name, archived_name, snapshot, 
+  digest, rowcount (None if the file wasn't loaded), status (see 
+  ARCHIVE_STATUSES), quick_key (None if unknown), and archived (a 
+  timestamp; see ts).'''
+
+  def __init__(self, path):
+    self.path = path
+    self._by_digest = {}
+    self._digests_by_quick_key = collections.defaultdict(set)
+    self._newest_ingested = None
+    self._lock = threading.Lock()
+    if os.path.exists(path):
+      with open(path, 'r') as f:
+        for line in f:
+          if line.strip():
+            self._remember(json.loads(line))
+
+  def _remember(self, entry):
+    # Entries from before the index covered the whole archive are all of 
+    # ingested files, archived under their own names.
+    entry.setdefault('status', 'ingested')
+    entry.setdefault('archived_name', entry['name'])
+    entry.setdefault('snapshot', snapshot_str(entry['name']))
+    if entry['status'] == 'ingested' and entry.get('quick_key'):
+      self._by_digest[entry['digest']] = entry
+      self._digests_by_quick_key[entry['quick_key']].add(entry['digest'])
+    if (entry['status'] == 'ingested' and entry['snapshot']
+        and (self._newest_ingested is None 
+             or entry['snapshot'] > self._newest_ingested['snapshot'])):
+      self._newest_ingested = entry
+
+  def find(self, fpath, sample):
+    '''Returns the entry for an already-ingested file identical to the one
+    at fpath, or None. Only reads through the file if its quick key 
+    matches one we've seen.'''
+    with self._lock:
+      candidates = self._digests_by_quick_key.get(quick_key(sample))
+      if not candidates:
+        return None
+      return self._by_digest.get(file_digest(fpath)) 
+
+  def newest_ingested(self):
+    '''Returns the entry for the ingested file with the latest snapshot, or
+    None.'''
+    with self._lock:
+      return self._newest_ingested
+
+  def add(self, entry):
+    with self._lock:
+      with open(self.path, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+      self._remember(entry)
+
+def archive_file(pl, path, status, digest=None, sample=None, rowcount=None):
+  '''Move the file at path into pl's archive (see above) and add it to the
+  index. Returns the path of the archived file. Failing to index it is 
+  logged, but doesn't fail the archiving.'''
+  fname = os.path.basename(path)
+  compress = pl.archive_compression == 'always' or (
+               pl.archive_compression == 'when_copying' 
+               and not same_filesystem(path, pl.archive_dir))
+  if compress:
+    dest_path = unused_archive_path(pl.archive_dir, fname + '.gz')
+    log.info('About to gzip {} to {}.'.format(path, dest_path))
+    digest = gzip_file(path, dest_path)
+    log.info('Gzipped {} to {}.'.format(path, dest_path))
+    del_file(path)
+  else:
+    dest_path = unused_archive_path(pl.archive_dir, fname)
+    move_file(path, dest_path)
+  forget_ready_file(path)
+  try:
+    if digest is None:
+      digest = file_digest(dest_path)
+    write_digest_sidecar(dest_path, digest, fname)
+    pl.ingest_index.add({'name': fname, 
+                         'archived_name': os.path.basename(dest_path),
+                         'snapshot': snapshot_str(fname), 
+                         'digest': digest, 'rowcount': rowcount, 
+                         'status': status,
+                         'quick_key': sample and quick_key(sample),
+                         'archived': ts()})
+  except Exception, ex:
+    log.error('Could not add {} to archive index: {}'.format(fname, ex))
+  return dest_path
+
+#------------------------------------------------------------------------------
+# agent jobs
+# Running a SQL Server Agent job and waiting for it to finish. The job is 
+# polled from a thread of its own, starting with short intervals which grow
+# (up to JOB_POLL_MAX_SECS) the longer it runs; if the job has run before, 
+# the first poll waits until it's nearly as far along as the job usually 
+# takes. Each poll is one sp_help_job call, which gives both whether the job
+# is running and how its last run turned out.
+
+# Durations (in seconds) of the latest runs of each job; see typical_duration.
+job_durations = collections.defaultdict(
+                  lambda: collections.deque(maxlen=JOB_DURATIONS_KEPT))
+
+def typical_duration(job_name):
+  '''Median of the job's recent durations, or None if it hasn't run yet.'''
+  durations = sorted(job_durations[job_name])
+  return durations[len(durations) // 2] if durations else None
+
+class JobRun(object):
+  '''A run of an Agent job that's been started; see run_agent_job.'''
+
+  def __init__(self, job_name, timeout, on_done=None, 
+               metadata_table_name=None):
+    self.job_name = job_name
+    self.timeout = timeout
+    self.on_done = on_done
+    self.metadata_table_name = metadata_table_name
+    self.duration = None # Seconds, once done.
+    self._succeeded = None
+    self._error = None
+    self._done = threading.Event()
+
+  def done(self):
+    return self._done.is_set()
+
+  def result(self, timeout=None):
+    '''Wait for the job to finish; returns True if it succeeded. Raises 
+    AgentJobThresholdException if it ran longer than its timeout, or 
+    whatever went wrong while polling it.'''
+    if not self._done.wait(timeout):
+      raise Exception('Still waiting on job [{}].'.format(self.job_name))
+    if self._error:
+      raise self._error
+    return self._succeeded
+
+  def _finish(self, succeeded=None, error=None):
+    self._succeeded, self._error = succeeded, error
+    self._done.set()
+    if self.on_done:
+      try:
+        self.on_done(self)
+      except Exception, ex:
+        log.error('Callback for job [{}] failed: {}'.format(self.job_name, 
+                                                            ex))
+
+  def _poll(self, last_run_before, started):
+    typical = typical_duration(self.job_name)
+    delay = max(JOB_POLL_MIN_SECS, 0.8 * typical if typical else 0)
+    interval = JOB_POLL_MIN_SECS
+    seen_running = False
+    while True:
+      time.sleep(min(delay, max(started + self.timeout - time.time(), 0)))
+      status = db_job_status(self.job_name)
+      elapsed = time.time() - started
+      last_run = (status['last_run_date'], status['last_run_time'])
+      # Idle right after being started might just mean the job hasn't
+      # started yet; it's done once we've seen it run, or its last run is
+      # a new one.
+      if status['current_execution_status'] != 4: # 4 means idle.
+        seen_running = True
+      elif seen_running or last_run != last_run_before:
+        return status['last_run_outcome'] == 1, elapsed # 1 means succeeded.
+      if elapsed > self.timeout:
+        raise AgentJobThresholdException('Runtime for job [{}] has exceeded '\
+            'specified threshold of {} seconds.' \
+            ''.format(self.job_name, self.timeout))
+      log.info('The job [{}] is not idle yet; waiting ...' \
+               ''.format(self.job_name))
+      delay = interval
+      interval = min(interval * JOB_POLL_BACKOFF, JOB_POLL_MAX_SECS)
+
+  def _run(self, last_run_before, started):
+    try:
+      succeeded, self.duration = self._poll(last_run_before, started)
+    except Exception, ex:
+      self._finish(error=ex)
+      return
+    job_durations[self.job_name].append(self.duration)
+    details = '{} in {:.1f} secs'.format(
+        'succeeded' if succeeded else 'failed', self.duration)
+    log.info('Job [{}] {} (typical: {:.1f} secs; timeout: {} secs).'.format(
+        self.job_name, details, typical_duration(self.job_name), 
+        self.timeout))
+    try:
+      if self.metadata_table_name:
+        update_metadata(self.metadata_table_name, self.job_name + '-job', 
+                        details)
+    except Exception, ex:
+      log.error('Could not record run of job [{}]: {}'.format(self.job_name,
+                                                             ex))
+    self._finish(succeeded)
+
+def run_agent_job(job_name, timeout, on_done=None, metadata_table_name=None):
+  '''Start a SQL Server Agent job and return a JobRun for it right away.
+  timeout is in seconds. on_done, if given, is called with the JobRun once
+  the job has finished (or we've stopped waiting on it). If 
+  metadata_table_name is given, the run's outcome and duration are 
+  recorded there.'''
+  run = JobRun(job_name, timeout, on_done, metadata_table_name)
+  status = db_job_status(job_name)
+  last_run_before = (status['last_run_date'], status['last_run_time'])
+  started = time.time()
+  db_start_job(job_name)
+  t = threading.Thread(target=run._run, args=(last_run_before, started),
+                       name='job-' + job_name)
+  t.daemon = True
+  t.start()
+  return run
+
 #------------------------------------------------------------------------------
 # load healthpro and redcap data
 
-def update_metadata(tag, details, dt=None):
+def update_metadata(metadata_table_name, tag, details, dt=None):
   '''Add a new row in the metadata table.
   dt arg is optional; should be a datetime object with tz of UTC. (if left out,
   the database uses the current time.) SQL Server datetime does not have
   any notion of time zone; we convert to local time zone first.'''
+  # We're just inserting one row; but we use db_bulk_insert for convenience.
   if dt:
+    import dateutil.tz
     local_tz = dateutil.tz.tzlocal()
     dt_local = dt.astimezone(local_tz)
-    db_insert_many(metadata_table_name
-                , [{'tag': tag, 'details': details, 'ts': dt_local}])
+    db_bulk_insert(metadata_table_name, ['tag', 'details', 'ts']
+                 , [(tag, details, dt_local)])
   else:
-    # We're just inserting one row; but we use db_insert_many for convenience.
-    db_insert_many(metadata_table_name
-                , [{'tag': tag, 'details': details}])
-
-def load_data_into_db(table_name, data):
-  db_trunc_table(table_name)
-  db_insert_many(table_name, data) 
-
-def redcap_rowcount():
-  return db_curr_rowcount(redcap_table_name)
-
-# TODO the pattern here can be abstracted out for any 
-# occasion we need to run a SQL Server job and poll for 
-# it to finish.
-def refresh_redcap_table():
-  log.info('Before truncating REDCap table, rowcount is {}.' \
-           ''.format(redcap_rowcount()))
-  log.info('About to truncate REDCap data table...')
-  db_trunc_table(redcap_table_name)
-  log.info('Truncated REDCap data table; rowcount is {} (should be 0).' \
-          ''.format(redcap_rowcount()))
-  log.info('About to repopulate REDCap table from source by calling SQL ' \
-          +'Server Agent job [{}].'.format(redcap_job_name))
-  db_start_job(redcap_job_name)
-  # Below we poll to see if the job has finished; when finished we check if
-  # it was successful. If the job is still running past the designated
-  # threshold, then we raise an exception, with the assumption that something
-  # is wrong.
-  waitfor = agent_job_timeout
-  interval = 10
-  havewaited = 0
-  while True:
-    time.sleep(interval)
-    if not db_is_job_idle(redcap_job_name):
-      havewaited += interval
-      log.info('The job [{}] is not idle yet; waiting ...' \
-               ''.format(redcap_job_name))
-      if havewaited > waitfor:
-        raise AgentJobThresholdException('Runtime for job [{}] has exceeded '\
-            'specified threshold of {} seconds.' \
-            ''.format(redcap_job_name, waitfor))
-      else:
-        continue
+    db_bulk_insert(metadata_table_name, ['tag', 'details']
+                 , [(tag, details)])
+
+def load_data_into_db(table_name, columns, rows, suspend_indexes=()):
+  '''Truncate and reload table_name in one transaction; if anything fails,
+  the table is left as it was. rows is an iterable of tuples whose values
+  are in the same order as columns; it's consumed a batch at a time.
+  The indexes named in suspend_indexes are disabled during the load and 
+  rebuilt after it (see sorted loads); if it fails, rolling back the 
+  transaction re-enables them. Returns number of rows inserted.'''
+  with db_transaction():
+    db_trunc_table(table_name)
+    db_disable_indexes(table_name, suspend_indexes)
+    count = db_bulk_insert(table_name, columns, rows)
+    db_rebuild_indexes(table_name, suspend_indexes)
+    return count
+
+def check_staging_table(staging_table_name, table_name, expected_rowcount=None):
+  '''Run before switching a staging table in: its columns have to match
+  those of the live table, and it has to have expected_rowcount rows (or 
+  if that's None, at least one row). Returns its rowcount. Throws.'''
+  if db_columns_for(staging_table_name) != db_columns_for(table_name):
+    raise Exception('Columns of staging table {} don\'t match those of {}.'\
+                    ''.format(staging_table_name, table_name))
+  rowcount = db_curr_rowcount(staging_table_name, expected_rowcount)
+  if ((expected_rowcount is None and rowcount == 0)
+      or (expected_rowcount is not None and rowcount != expected_rowcount)):
+    raise Exception('Staging table {} has {} rows; expected {}.'.format(
+        staging_table_name, rowcount, expected_rowcount or 'at least 1'))
+  log.info('Checked staging table {}: {} rows.'.format(staging_table_name,
+                                                       rowcount))
+  return rowcount
+
+def load_healthpro_csv(pl, fname, csvfile, rows, db_rowcount_before):
+  '''Load the rows of a deposited CSV (see handle_csv) into the HealthPro 
+  table -- fully, or in delta mode just the changes -- finishing the checks
+  on the file as it's read. If the file turns out to be bad, nothing is 
+  changed and CsvRejectedException is raised. Returns DeltaCounts in delta
+  mode, else None.
+  For a full load with a staging table configured, the staging table is 
+  loaded (in parallel, if the pipeline's parallel_workers > 1 and it has 
+  no sort_key; see parallel loads) and checked, and then switched in. (A
+  delta load is applied to the live table, in one transaction.)'''
+  converter = RowConverter(csvfile.header,
+                           db_column_info_for(pl.healthpro_table_name))
+  rows = converter.convert_rows(rows)
+  snapshot = None
+  if pl.load_mode == 'delta':
+    snapshot = DeltaSnapshot(pl.delta_snapshot_path, pl.healthpro_table_name)
+  staging = None if snapshot else pl.healthpro_staging_table_name
+  parallel = False
+  if pl.parallel_workers > 1:
+    if not staging:
+      log.info('Parallel loads need a staging table (and a full load); '\
+               'loading serially.')
+    elif pl.sort_key:
+      log.info('Parallel loads can\'t keep rows in sort_key order; '\
+               'loading serially.')
     else:
-      break
-  if not db_last_run_succeeded(redcap_job_name):
-    msg = 'The Agent job [{}] did not run successfully.'.format(redcap_job_name)
-    log.error(msg)
-    raise Exception(msg)
-  else:
-    log.info('Successfully ran [{}]. REDCap table rowcount: [{}].' \
-            ''.format(redcap_job_name, redcap_rowcount()))
-    update_metadata(unadorned_table_name(redcap_table_name), 'refreshed')
-    return True 
+      parallel = load_data_in_parallel(csvfile, staging, converter,
+                                       pl.parallel_workers, 
+                                       pl.suspend_indexes)
+  try:
+    delta = None
+    with db_transaction():
+      if snapshot:
+        delta = load_delta_into_db(pl.healthpro_table_name, csvfile.header,
+                                   rows, snapshot)
+      elif not parallel:
+        if pl.sort_key:
+          rows = sorted_rows(rows, sort_key_positions(csvfile.header, 
+                                                      pl.sort_key))
+        load_data_into_db(staging or pl.healthpro_table_name, 
+                          csvfile.header, rows, pl.suspend_indexes)
+      if not csvfile.encoding_ok:
+        raise CsvRejectedException(BAD_ENCODING_NOTICE.format(fname))
+      if not csvfile.format_ok:
+        raise CsvRejectedException(BAD_FORMAT_NOTICE.format(fname))
+      if converter.error_count:
+        raise CsvRejectedException(converter.notice(fname))
+      if not check_csv_rowcount(csvfile.rowcount, db_rowcount_before):
+        raise CsvRejectedException(LOW_ROWCOUNT_NOTICE.format(fname))
+    if staging:
+      check_staging_table(staging, pl.healthpro_table_name, csvfile.rowcount)
+      db_switch_in(staging, pl.healthpro_table_name)
+    if not snapshot:
+      # A full reload makes any snapshot out of date.
+      discard_delta_snapshot(pl.delta_snapshot_path)
+      return None
+    try:
+      snapshot.commit()
+    except Exception, ex:
+      log.error('Could not save delta snapshot: ' + str(ex))
+      snapshot.close()
+      discard_delta_snapshot(pl.delta_snapshot_path)
+    return delta
+  except DeltaSnapshotException:
+    # Nothing was committed; the next ingest does a full reload.
+    snapshot.close()
+    discard_delta_snapshot(pl.delta_snapshot_path)
+    raise
+  finally:
+    if snapshot:
+      snapshot.close()
+
+def refresh_redcap_table(pl):
+  '''Timed as a run of its own; see metrics.'''
+  run = start_run(pl, 'redcap')
+  outcome = 'error'
+  try:
+    # If there's a staging table, the Agent job should be set up to populate
+    # it rather than the live table; we switch it in once the job is done.
+    target_table_name = pl.redcap_staging_table_name or pl.redcap_table_name
+    run.begin('truncate')
+    log.info('Before refreshing REDCap table, rowcount is {}.' \
+             ''.format(db_curr_rowcount(pl.redcap_table_name)))
+    log.info('About to truncate REDCap data table {}...'\
+             ''.format(target_table_name))
+    db_trunc_table(target_table_name)
+    log.info('Truncated REDCap data table.')
+    log.info('About to repopulate REDCap table from source by calling SQL ' \
+            +'Server Agent job [{}].'.format(pl.redcap_job_name))
+    # If the job is still running past the designated threshold, then 
+    # result() raises an exception, with the assumption that something is 
+    # wrong.
+    run.begin('agent_job')
+    job = run_agent_job(pl.redcap_job_name, pl.agent_job_timeout, 
+                        metadata_table_name=pl.metadata_table_name)
+    if not job.result():
+      msg = 'The Agent job [{}] did not run successfully.'\
+            ''.format(pl.redcap_job_name)
+      log.error(msg)
+      raise Exception(msg)
+    else:
+      run.begin('verify')
+      if pl.redcap_staging_table_name:
+        rowcount = check_staging_table(pl.redcap_staging_table_name, 
+                                       pl.redcap_table_name)
+        db_switch_in(pl.redcap_staging_table_name, pl.redcap_table_name)
+      else:
+        rowcount = db_curr_rowcount(pl.redcap_table_name)
+      run.rows = rowcount
+      log.info('Successfully ran [{}]. REDCap table rowcount: [{}].' \
+              ''.format(pl.redcap_job_name, rowcount))
+      update_metadata(pl.metadata_table_name, 
+                      unadorned_table_name(pl.redcap_table_name), 'refreshed')
+      outcome = 'refreshed'
+      return True 
+  finally:
+    end_run(run, outcome)
   
+#------------------------------------------------------------------------------
+# watching the inbox
+
+def mount_fstype(path):
+  '''Returns the type of the filesystem path is on (per /proc/mounts), or
+  None if we can't tell. Doesn't touch path itself (so as not to hang on a
+  dead mount); so, a symlink is taken to be on the filesystem it's in, 
+  not the one it points to.'''
+  try:
+    with open('/proc/mounts', 'r') as f:
+      mounts = [line.split()[1:3] for line in f]
+  except IOError:
+    return None
+  path = os.path.abspath(path)
+  best_mnt, fstype = '', None
+  for mnt, typ in mounts:
+    mnt = mnt.decode('string_escape') # E.g., spaces show up as \040.
+    under = path == mnt or path.startswith(mnt.rstrip('/') + '/')
+    if under and len(mnt) > len(best_mnt):
+      best_mnt, fstype = mnt, typ
+  return fstype
+
+def make_observer():
+  '''Returns a Watchdog observer for the inboxes. By default (inbox_watcher
+  of 'auto') that's the native one (inotify, on Linux) if every inbox is on
+  a local filesystem, or a polling one if any is on a network mount (or we 
+  can't tell).'''
+  kind = inbox_watcher
+  if kind == 'auto':
+    kind = 'native'
+    for pl in pipelines:
+      fstype = mount_fstype(pl.inbox_dir)
+      if fstype is None or fstype in NETWORK_FS_TYPES:
+        kind = 'polling'
+      log.info('Inbox {} filesystem type is [{}].'.format(pl.inbox_dir, 
+                                                          fstype))
+    log.info('Using {} observer.'.format(kind))
+  if kind == 'native':
+    from watchdog.observers import Observer
+    return Observer()
+  from watchdog.observers.polling import PollingObserver
+  return PollingObserver(timeout=5) # check every 5 seconds
+
+class IngestQueue(object):
+  '''Paths of files waiting to be processed, by pipeline, and the worker
+  thread(s) that process them; this way the observer thread only ever 
+  enqueues, and goes right back to watching. A path that's already waiting
+  isn't added again. At most maxsize paths can be waiting in all.
+  Once window_secs have passed since a pipeline's first waiting file 
+  arrived, a free worker takes all of that pipeline's waiting files and 
+  calls func(pl, paths, requeued, take_more) (so a burst of files can be
+  handled together); requeued is the set of those paths that were only 
+  re-queued (see put), and take_more takes the files that have arrived for
+  the pipeline since (see take_waiting).
+  A pipeline's files are only ever handled by one worker at a time, since
+  they go to the same tables; otherwise the pipeline that has been waiting
+  longest goes first.'''
+
+  def __init__(self, func, nworkers=1, maxsize=INGEST_QUEUE_MAX, 
+               window_secs=0):
+    self.func = func
+    self.maxsize = maxsize
+    self.window_secs = window_secs
+    self._cond = threading.Condition()
+    # pipeline -> (arrival time of first, [paths], set of re-queued paths)
+    self._waiting = {}
+    self._busy = set() # pipelines a worker is on
+    self._stopping = False
+    self._workers = [threading.Thread(target=self._work,
+                                      name='ingest-worker-{}'.format(i))
+                     for i in range(nworkers)]
+    for t in self._workers:
+      t.daemon = True
+
+  def start(self):
+    for t in self._workers:
+      t.start()
+
+  def put(self, pl, path, requeue=False):
+    '''Returns False if path wasn't added (already waiting, or no room).
+    requeue is for a file that's changed since it was put (see 
+    make_handler_obj), which there's no need to log if it's still 
+    waiting.'''
+    with self._cond:
+      _, paths, requeued = self._waiting.get(pl, (None, [], set()))
+      if path in paths:
+        if not requeue:
+          # It's been deposited anew since it was re-queued.
+          requeued.discard(path)
+          log.info('Already waiting to be processed: ' + path)
+        return False
+      if self.depth() >= self.maxsize:
+        msg = 'Too many files are waiting to be processed; {} was '\
+              'skipped. Please deposit it again later.'.format(path)
+        log.error(msg)
+        send_notice_email(msg)
+        return False
+      self._waiting.setdefault(pl, (time.time(), paths, requeued))
+      paths.append(path)
+      if requeue:
+        requeued.add(path)
+        log.info('Re-queued {} (it has changed).'.format(path))
+      self._cond.notify_all()
+      return True
+
+  def _take(self):
+    '''Returns (pipeline, paths, requeued) once some pipeline is due; or 
+    None if we've been told to stop.'''
+    with self._cond:
+      while not self._stopping:
+        ready = [(x[0], pl) for pl, x in self._waiting.items()
+                 if pl not in self._busy]
+        if not ready:
+          self._cond.wait()
+          continue
+        since, pl = min(ready, key=lambda x: x[0])
+        wait = since + self.window_secs - time.time()
+        if wait > 0:
+          self._cond.wait(wait)
+          continue
+        self._busy.add(pl)
+        return (pl,) + self._waiting.pop(pl)[1:]
+      return None
+
+  def take_waiting(self, pl):
+    '''For the worker on pipeline pl: takes the pipeline's files that are
+    waiting. Returns (paths, requeued); see above.'''
+    with self._cond:
+      return self._waiting.pop(pl, (None, [], set()))[1:]
+
+  def _work(self):
+    while True:
+      taken = self._take()
+      if taken is None:
+        return
+      pl, paths, requeued = taken
+      try:
+        self.func(pl, paths, requeued, lambda: self.take_waiting(pl))
+      finally:
+        with self._cond:
+          self._busy.discard(pl)
+          self._cond.notify_all()
+
+  def depth(self):
+    '''Number of files waiting.'''
+    with self._cond:
+      return sum(len(x[1]) for x in self._waiting.values())
+
+  def is_alive(self):
+    return all(t.is_alive() for t in self._workers)
+
+  def stop(self, timeout=None):
+    '''Lets the workers finish what they're doing, then stops them. Files
+    still waiting are left in their inbox.'''
+    with self._cond:
+      self._stopping = True
+      self._cond.notify_all()
+    for t in self._workers:
+      t.join(timeout)
+
+def make_handler_obj(pl, on_created_func):
+  '''Create and return a new FileSystemEventHandler object (this class
+  is part of the Watchdog library.) which has custom handler functions
+  specific to our needs. on_created_func is called with pipeline pl and
+  the path of each file that appears in its inbox; and again, with a third
+  arg of True, each time the file is modified or (where the observer 
+  reports it, e.g. inotify's IN_CLOSE_WRITE in newer versions of Watchdog)
+  closed after writing. That way a file that was taken to be complete 
+  while it was still being copied (see wait_for_file_ready) is tried again
+  once it has changed. A file that appears (or goes away) is forgotten by
+  ready_file_stats, so it's processed even if it looks the same as a file
+  of that name did before (e.g., a re-deposit that kept its mtime).'''
+  from watchdog.events import FileSystemEventHandler
+  gone_key = 'inbox-gone:' + pl.inbox_dir
+  class FSEHandler(FileSystemEventHandler):
+    # Here we define what we'd like to do when certain filesystem
+    # events take place -- e.g., when a new CSV appears in the watched
+    # directory.
+    # Uncomment on_any_event for extra logging.
+    #def on_any_event(self, event):
+    #  log.info('FSEHandler->on_any_event: event_type=[' \
+    #           '{}], src_path=[{}]'.format(event.event_type, event.src_path))
+    def on_deleted(self, event):
+      # Our forked Watchdog (v0.8.3.1) emits this event when inbox folder 
+      # unmounts (or otherwise is not available).
+      # We send an email only once. It very well might remount without 
+      # us needing to do anything.
+      if event.src_path == pl.inbox_dir:
+        msg = event.src_path + ' is gone!'
+        log.error(msg)
+        send_notice_email(msg, once_key=gone_key)
+      elif not event.is_directory:
+        forget_ready_file(event.src_path)
+    def on_created(self, event):
+      # If a file appears we know the inbox is back and all is well; so
+      # we'll email again if it goes away again.
+      notifier.resolve(gone_key)
+      if event.is_directory:
+        return
+      log.info('FSEHandler->on_created: a new file has appeared: '
+               + event.src_path)
+      forget_ready_file(event.src_path)
+      on_created_func(pl, event.src_path)
+    def on_moved(self, event):
+      # E.g., a browser downloads to a temp name, then renames the file
+      # once it's done.
+      if event.is_directory:
+        return
+      forget_ready_file(event.src_path)
+      if os.path.dirname(event.dest_path) == os.path.normpath(pl.inbox_dir):
+        log.info('FSEHandler->on_moved: a file was renamed into place: '
+                 + event.dest_path)
+        forget_ready_file(event.dest_path)
+        on_created_func(pl, event.dest_path)
+    def on_modified(self, event):
+      if not event.is_directory:
+        on_created_func(pl, event.src_path, True)
+    def on_closed(self, event):
+      # Only called by versions of Watchdog that report it.
+      if not event.is_directory:
+        on_created_func(pl, event.src_path, True)
+  return FSEHandler()
+
+#------------------------------------------------------------------------------
+# profiling
+# Opt-in: with profile_every set to N (in the config file, or with 
+# --profile-every N on the command line), one in every N runs of 
+# process_file is run under cProfile and a MemoryTracer; and whenever a file
+# named PROFILE_NEXT_FLAG is put next to the log, the next run is (and the 
+# file is removed). For each profiled run, two files are written next to the
+# log, named for the CSV and when it ran: a .prof dump (load it with pstats, 
+# or a viewer such as snakeviz) and a .txt report of the top functions and 
+# the top sites where memory grew.
+# Python 2 has no tracemalloc, so the memory tracer is approximate: it samples
+# the process's RSS every MEM_TRACE_INTERVAL_SECS and charges any growth to
+# the line (in this file) the run's thread was at; plus, it compares the 
+# counts of live objects by type before and after the run.
+
+PROFILE_NEXT_FLAG = 'profile_next'
+PROFILE_TOP_N = 30
+MEM_TRACE_INTERVAL_SECS = 0.01
+
+# Profiled runs are the profile_every-th, 2*profile_every-th, etc.
+profile_run_counter = itertools.count(1)
+
+def should_profile():
+  flag_path = os.path.join(log_dir, PROFILE_NEXT_FLAG)
+  if os.path.exists(flag_path):
+    try:
+      os.remove(flag_path)
+      return True
+    except OSError:
+      pass # Another worker got to it first.
+  return (profile_every > 0 
+          and next(profile_run_counter) % profile_every == 0)
+
+def current_rss():
+  '''Resident set size of this process in bytes, or None if we can't tell
+  (it's read from /proc, so Linux only).'''
+  try:
+    with open('/proc/self/statm') as f:
+      return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+  except (IOError, OSError, ValueError):
+    return None
+
+def live_object_counts():
+  return collections.Counter(type(x).__name__ for x in gc.get_objects())
+
+def same_module_file(path_a, path_b):
+  '''E.g., main.py and /path/to/main.pyc are.'''
+  stem = lambda p: os.path.splitext(os.path.abspath(p))[0]
+  return stem(path_a) == stem(path_b)
+
+class MemoryTracer(object):
+  '''See above. Traces the thread with ident thread_id from start() until
+  stop().'''
+
+  def __init__(self, thread_id, interval=MEM_TRACE_INTERVAL_SECS):
+    self.thread_id = thread_id
+    self.interval = interval
+    self.growth = collections.Counter() # (file, line, func) -> bytes
+    self.start_rss = self.peak_rss = self.end_rss = None
+    self.objects_before = None
+    self.object_growth = None
+    self._stopping = threading.Event()
+    self._thread = threading.Thread(target=self._run, name='memory-tracer')
+    self._thread.daemon = True
+
+  def start(self):
+    self.objects_before = live_object_counts()
+    self.start_rss = self.peak_rss = current_rss()
+    self._thread.start()
+
+  def stop(self):
+    self._stopping.set()
+    self._thread.join()
+    self.end_rss = current_rss()
+    after = live_object_counts()
+    after.subtract(self.objects_before)
+    self.object_growth = collections.Counter(
+        dict((k, n) for k, n in after.items() if n > 0))
+
+  def _site(self):
+    '''The innermost frame in this file of the traced thread, or else its 
+    innermost frame.'''
+    frame = sys._current_frames().get(self.thread_id)
+    innermost = frame
+    while frame and not same_module_file(frame.f_code.co_filename, __file__):
+      frame = frame.f_back
+    frame = frame or innermost
+    if not frame:
+      return None
+    return (os.path.basename(frame.f_code.co_filename), frame.f_lineno,
+            frame.f_code.co_name)
+
+  def _run(self):
+    last = self.start_rss
+    if last is None:
+      return
+    while not self._stopping.wait(self.interval):
+      rss = current_rss()
+      if rss > last:
+        site = self._site()
+        if site:
+          self.growth[site] += rss - last
+      self.peak_rss = max(self.peak_rss, rss)
+      last = rss
+
+  def report(self, top_n):
+    mb = lambda n: '{:.1f} MB'.format(n / 1048576.0) if n is not None else '?'
+    lines = ['RSS: {} at start, {} at peak, {} at end.'.format(
+                 mb(self.start_rss), mb(self.peak_rss), mb(self.end_rss)),
+             '', 'Top sites where RSS grew:']
+    for (fname, lineno, func), n in self.growth.most_common(top_n):
+      lines.append('  {:>10}  {}:{} ({})'.format(mb(n), fname, lineno, func))
+    lines += ['', 'Live objects added, by type:']
+    for typ, n in self.object_growth.most_common(top_n):
+      lines.append('  {:>10}  {}'.format(n, typ))
+    return '\n'.join(lines) + '\n'
+
+def profiled_call(tag, func, *args):
+  '''Call func(*args) under cProfile and a MemoryTracer, and write the 
+  results next to the log (see above), in files named for tag. Returns what
+  func returns.'''
+  import cProfile
+  import pstats
+  import StringIO
+  prefix = os.path.join(log_dir, 'profile-{}-{}'.format(
+               re.sub(r'[^\w.-]', '_', tag), time.strftime('%Y%m%d-%H%M%S')))
+  log.info('Profiling this run; see {}.*'.format(prefix))
+  tracer = MemoryTracer(threading.current_thread().ident)
+  tracer.start()
+  profiler = cProfile.Profile()
+  try:
+    return profiler.runcall(func, *args)
+  finally:
+    tracer.stop()
+    try:
+      profiler.dump_stats(prefix + '.prof')
+      out = StringIO.StringIO()
+      out.write('Profile of {}\n\n'.format(tag))
+      pstats.Stats(profiler, stream=out).sort_stats('cumulative')\
+                                        .print_stats(PROFILE_TOP_N)
+      out.write(tracer.report(PROFILE_TOP_N))
+      with open(prefix + '.txt', 'w') as f:
+        f.write(out.getvalue())
+    except Exception, ex:
+      log.error('Could not write profile: {}'.format(ex))
+
+def profiled_process_file(pl, path):
+  '''process_file, under the profiler if this run is one to profile.'''
+  if not is_sys_file(path) and should_profile():
+    return profiled_call(os.path.basename(path), process_file, pl, path)
+  return process_file(pl, path)
+
 #------------------------------------------------------------------------------
 # driver
 
-def process_file(path):
+# Notices sent when a deposited file is rejected; format with the filename.
+BAD_ENCODING_NOTICE = \
+    'The character encoding of the deposited CSV ({}) '\
+    'doesn\'t match what\'s '\
+    'expected; so, it was not processed. \n\nOne way this could happen '\
+    'is if the file were opened in Excel or another application and then '\
+    'saved from within that application (even when saved as a CSV).'\
+    ' \n\nAnother possibility is that a slow connection to the network folder '\
+    'resulted in the Ingester attempting to process the file before it had '\
+    'completely copied over.'
+BAD_FORMAT_NOTICE = \
+    'The format of the deposited CSV ({}) doesn\'t match what\'s '\
+    'expected; so, it was not processed. Please check.'
+BAD_VALUES_NOTICE = \
+    'Some values in the deposited CSV ({}) don\'t fit the database columns '\
+    'they belong in; so, it was not processed. Please check. The bad '\
+    'values are listed below (row numbers count data rows only).'
+LOW_ROWCOUNT_NOTICE = \
+    'The number of rows of data in the deposited CSV ({}) is fewer '\
+    'than in the database; so, it was not processed. '\
+    'Please check.'
+ALREADY_INGESTED_NOTICE = \
+    'The deposited CSV ({}) is identical to one that was already ingested '\
+    '({}); so, it was archived without being loaded again.'
+STILL_WRITING_NOTICE = \
+    'The deposited file ({}) was still being written to after {} seconds; '\
+    'so, it was not processed. Please check, and deposit it again once it '\
+    'has completely copied over.'
+
+def process_file(pl, path):
+  '''Process a file deposited in pipeline pl's inbox. Returns True if the 
+  file was loaded into the db (now, or by an earlier
+  ingest of an identical file).'''
   log.info('----------process_file called------------------------------------')
+  # Should we ignore this file?
+  if is_sys_file(path):
+    return    
+  fname = os.path.basename(path) 
+  loaded = False
+  redcap_refresh = None # Only if pl.concurrent_redcap_refresh.
+  # Once that's started, the email about how the file fared waits for it
+  # (see finally), so there's one email about both: (send func, message).
+  email = None
+  run = start_run(pl, 'healthpro', fname) # See metrics.
+  outcome = 'rejected'
   try:
-    # sleep to ensure process writing to file is finished before we start.
+    run.begin('wait_ready')
+    # Make sure the process writing to the file is finished before we start.
     # E.g., if downloading directly into inbox folder using a browser, the
     # file will not be all there initially.
-    time.sleep(30)
-    # Should we ignore this file?
-    if is_sys_file(path):
-      return    
+    if not wait_for_file_ready(path):
+      if os.path.exists(path):
+        msg = STILL_WRITING_NOTICE.format(fname, file_ready_timeout)
+        log.info(msg)
+        send_notice_email(msg)
+      return
     # Do some sanity checks on the file.
-    fname = os.path.basename(path) 
-    if not check_filename_format(path):
+    run.begin('filename_check')
+    if not check_filename_format(pl, path):
       msg = 'The deposited file ({}) has an unexpected filename; '\
             'so, it was not processed. Please check.'.format(fname)  
       log.info(msg)
       send_notice_email(msg)
       return
-    if not check_char_encoding_is_utf8sig(path):
-      msg = 'The character encoding of the deposited CSV ({}) '\
-            'doesn\'t match what\'s '\
-            'expected; so, it was not processed. \n\nOne way this could happen '\
-            'is if the file were opened in Excel or another application and then '\
-            'saved from within that application (even when saved as a CSV).'\
-            ' \n\nAnother possibility is that a slow connection to the network folder '\
-            'resulted in the Ingester attempting to process the file before it had '\
-            'completely copied over.'\
-            ''.format(fname)  
+    # Quick checks: these only look at the head and tail of the file.
+    run.begin('sample')
+    sample = sample_file(path)
+    run.bytes_read += len(sample.head) + (len(sample.tail) 
+                                          if sample.size > len(sample.head)
+                                          else 0)
+    # Have we already ingested this very file?
+    run.begin('dedup_check')
+    dup = pl.ingest_index.find(path, sample)
+    if dup:
+      outcome = 'duplicate'
+      archive_file(pl, path, 'duplicate', dup['digest'], sample)
+      msg = ALREADY_INGESTED_NOTICE.format(fname, dup['name'])
+      log.info(msg)
+      send_notice_email(msg)
+      return True
+    run.begin('encoding_check')
+    if not check_char_encoding_is_utf8sig(sample):
+      msg = BAD_ENCODING_NOTICE.format(fname)
       log.info(msg)
       send_notice_email(msg)
       return
-    if not check_hp_csv_format(path):
-      msg = 'The format of the deposited CSV ({}) doesn\'t match what\'s '\
-            'expected; so, it was not processed. Please check.'.format(fname)  
+    run.begin('format_check')
+    if not check_hp_csv_format(sample):
+      msg = BAD_FORMAT_NOTICE.format(fname)
       log.info(msg)
       send_notice_email(msg)
       return
-    if not check_csv_rowcount(path):
-      msg = 'The number of rows of data in the deposited CSV ({}) is fewer '\
-            'than in the database; so, it was not processed. '\
-            'Please check.'.format(fname)  
+    run.begin('rowcount_estimate')
+    db_rowcount_before = db_curr_rowcount(pl.healthpro_table_name)
+    est_rowcount = estimate_csv_rowcount(sample)
+    log.info('Estimated rowcount of {}: [{}]; db rowcount: [{}].'\
+             ''.format(fname, est_rowcount, db_rowcount_before))
+    if not check_csv_rowcount_estimate(est_rowcount, db_rowcount_before):
+      msg = LOW_ROWCOUNT_NOTICE.format(fname)
       log.info(msg)
       send_notice_email(msg)
       return
-    # So far so good. Proceed to read in csv.
-    data = handle_csv(path)
-    log.info('Handled csv successfully')
-    if not check_csv_column_names(data):
+    if pl.concurrent_redcap_refresh:
+      # The REDCap data doesn't depend on the HealthPro data, so it can be
+      # refreshed while we load.
+      log.info('Starting REDCap refresh alongside the HealthPro load.')
+      redcap_refresh = BackgroundCall(refresh_redcap_table, pl)
+    # Full checks: these happen as the file is read, which is as it's loaded
+    # into the db -- all in one transaction, so that if the file turns out to
+    # be bad the db is left as it was.
+    run.begin('load')
+    csvfile, rows = handle_csv(path)
+    if not csvfile.encoding_ok:
+      raise CsvRejectedException(BAD_ENCODING_NOTICE.format(fname))
+    if not check_csv_column_names(pl, csvfile.header):
+      archive_file(pl, path, 'rejected', sample=sample)
       msg = 'The columns in the deposited CSV ({}) don\'t match expectations; '\
             'so, it was archived but not processed. Please check.'.format(fname)  
       log.info(msg)
-      send_notice_email(msg)
+      email = (send_notice_email, msg)
       return
     log.info('About to load into database.')
-    load_data_into_db(healthpro_table_name, data)
+    try:
+      delta = load_healthpro_csv(pl, fname, csvfile, rows, 
+                                 db_rowcount_before)
+    finally:
+      run.bytes_read += csvfile.bytes_read
+    run.rows = csvfile.rowcount
+    loaded = True
     log.info('Successfully loaded into database.')
-    csv_rowcount = len(data)
-    db_rowcount = db_curr_rowcount(healthpro_table_name)
+    log.info('Read {} rows from {}; SHA-1 digest: {}.'\
+             ''.format(csvfile.rowcount, fname, csvfile.digest))
+    # So far so good. Archive the csv.
+    run.begin('archive')
+    archive_file(pl, path, 'ingested', csvfile.digest, sample, 
+                 csvfile.rowcount)
+    log.info('Handled csv successfully')
+    run.begin('verify')
+    csv_rowcount = csvfile.rowcount
+    db_rowcount = db_curr_rowcount(pl.healthpro_table_name, csv_rowcount)
     log.info('Stats: csv rowcount: [' + str(csv_rowcount) + ']; '\
              'db rowcount: [' + str(db_rowcount) + '].')
     if csv_rowcount == db_rowcount:
       log.info('Processed ' + path + ' successfully!')
       # Note this refresh in the metadata table.
       hp_csv_datetime_obj = datetime_from_csv_filename(path)
-      just_table = unadorned_table_name(healthpro_table_name)
-      update_metadata(just_table, 'refreshed', hp_csv_datetime_obj)
-      # Now that we're done wtih the HealthPro side, refresh our REDCap data.
-      if refresh_redcap_table():
+      just_table = unadorned_table_name(pl.healthpro_table_name)
+      update_metadata(pl.metadata_table_name, just_table, 'refreshed', 
+                      hp_csv_datetime_obj)
+      if delta:
+        details = 'inserted: {}, updated: {}, withdrawn: {}'\
+                  ''.format(delta.inserted, delta.updated, delta.withdrawn)
+        log.info('Delta load: ' + details)
+        update_metadata(pl.metadata_table_name, just_table + '-delta', 
+                        details, hp_csv_datetime_obj)
+      # Now that we're done wtih the HealthPro side, refresh our REDCap data
+      # (or wait for the refresh that was started alongside the load).
+      run.begin('redcap_refresh')
+      if redcap_refresh:
+        refresh, redcap_refresh = redcap_refresh, None
+        redcap_ok = refresh.result()
+      else:
+        redcap_ok = refresh_redcap_table(pl)
+      if redcap_ok:
         log.info('Refreshed REDCap data successfully!')
         log.info('Everything is done. Sending success email.')
-        send_success_email()
+        outcome = 'loaded'
+        send_success_email(pl)
       else:
         raise Exception('Something went wrong when refreshing REDCap data.')
     else:
+      outcome = 'error'
       log.error('Rowcounts do not match.')
-      send_error_email('Final rowcounts do not match; please check.')
+      # If this was a delta load, the snapshot can't be trusted either.
+      discard_delta_snapshot(pl.delta_snapshot_path)
+      email = (send_error_email, 'Final rowcounts do not match; please check.')
+  except CsvRejectedException, rex:
+    msg = str(rex)
+    log.info(msg)
+    email = (send_notice_email, msg)
   except AgentJobThresholdException, aex:
+    outcome = 'error'
     log.error(str(aex))
-    send_error_email('{}. (It was started after ingesting {}.) Please check.' \
-        ''.format(str(aex), fname))
+    email = (send_error_email, '{}. (It was started after ingesting {}.) '\
+             'Please check.'.format(str(aex), fname))
   except Exception, ex:
+    outcome = 'error'
     log.error(str(ex))
-    send_error_email('An error occurred while processing {}. Please check.' \
-        ''.format(fname))
+    email = (send_error_email, 'An error occurred while processing {}. '\
+             'Please check.'.format(fname))
+  finally:
+    if redcap_refresh:
+      # The HealthPro side didn't make it, but the REDCap refresh went ahead.
+      try:
+        if not redcap_refresh.result():
+          raise Exception('Something went wrong when refreshing REDCap data.')
+        log.info('Refreshed REDCap data successfully!')
+      except Exception, ex:
+        log.error(str(ex))
+        msg = 'Something went wrong when refreshing REDCap data (alongside '\
+              'processing {}). Please check.'.format(fname)
+        email = (send_error_email, email[1] + '\n' + msg if email else msg)
+    if email:
+      send, msg = email
+      send(msg)
+    end_run(run, outcome)
+  return loaded
 
-def make_handler_obj(on_created_func):
-  '''Create and return a new FileSystemEventHandler object (this class
-  is part of the Watchdog library.) which has custom handler functions
-  specific to our needs.'''
-  pass
+def process_files(pl, paths, requeued=(), take_more=None):
+  '''Process a burst of files deposited in pipeline pl's inbox. Each CSV is
+  a full snapshot, so only the newest one needs loading: we try them 
+  newest first (going by the date and time in their filenames), and once
+  one loads, the older ones are archived as superseded -- as are any no 
+  newer than the newest file already ingested, without trying them. Files
+  without a date and time in their names are processed one by one (i.e., 
+  rejected). Those of paths in requeued (see IngestQueue) are skipped if 
+  they haven't changed since they were last found ready. take_more, if 
+  given, is called once the first file is ready, for more files (and 
+  requeued paths among them) to handle with these.'''
+  def csv_datetime(path):
+    try:
+      return datetime_from_csv_filename(path)
+    except Exception:
+      return None
+  # A re-queued file may have been archived since, or be unchanged since it
+  # was last processed.
+  paths = [p for p in paths if p not in requeued or changed_since_ready(p)]
+  if paths and take_more:
+    # The rest of the burst may have arrived while the first file was being
+    # written; if so, it's handled now rather than file by file.
+    wait_for_file_ready(paths[0])
+    more, requeued = take_more()
+    paths += [p for p in more if p not in paths
+              and (p not in requeued or changed_since_ready(p))]
+  dated = [p for p in paths 
+           if check_filename_format(pl, p) and csv_datetime(p)]
+  for path in paths:
+    if path not in dated:
+      profiled_process_file(pl, path)
+  dated.sort(key=csv_datetime, reverse=True)
+  newest = None
+  try:
+    newest = pl.ingest_index.newest_ingested() if dated else None
+  except Exception, ex:
+    log.error('Could not read the ingest index: ' + str(ex))
+  if newest:
+    stale = [p for p in dated if snapshot_str(p) <= newest['snapshot']]
+    if stale:
+      log.info('{} files are no newer than {}, which was already '\
+               'ingested.'.format(len(stale), newest['name']))
+      archive_superseded(pl, stale, newest['name'])
+      dated = [p for p in dated if p not in stale]
+  if len(dated) > 1:
+    log.info('Coalescing {} files; newest is {}.'.format(len(dated), 
+                                                         dated[0]))
+  for i, path in enumerate(dated):
+    if profiled_process_file(pl, path):
+      archive_superseded(pl, dated[i+1:], path)
+      return
+
+def archive_superseded(pl, paths, newest_path):
+  '''Archive files, unprocessed, that a newer file was loaded in place of,
+  and note each one in the metadata table.'''
+  just_table = unadorned_table_name(pl.healthpro_table_name)
+  newest_fname = os.path.basename(newest_path)
+  for path in paths:
+    fname = os.path.basename(path)
+    try:
+      if not wait_for_file_ready(path):
+        log.info('Left superseded file {} in place.'.format(fname))
+        continue
+      archive_file(pl, path, 'superseded')
+      update_metadata(pl.metadata_table_name, just_table + '-superseded', 
+                      '{} (by {})'.format(fname, newest_fname),
+                      datetime_from_csv_filename(path))
+      log.info('Archived {}; superseded by {}.'.format(fname, newest_fname))
+    except Exception, ex:
+      log.error('Could not archive superseded file {}: {}'.format(fname, ex))
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser(description='HealthPro CSV Ingester.')
+  parser.add_argument('--profile-every', type=int, metavar='N',
+                      help='profile one in every N ingests (overrides '
+                           'profile_every in the config file; 0 for none)')
+  return parser.parse_args(argv)
 
 def main():
+  global profile_every
+  args = parse_args(sys.argv[1:])
+  if args.profile_every is not None:
+    profile_every = args.profile_every
   print 'Starting main...'
   log.info('--------------------------------------------------------------------')
   log.info('HealthPro CSV Ingester service started.')
-  log.info('Details about database from config file: Server: {}, DB Table: {}, '\
-           ''.format(db_info['host'], healthpro_table_name))
-  observer = PollingObserver(timeout=5) # check every 5 seconds
+  log.info('Details about database from config file: Server: {}.'\
+           ''.format(db_info['host']))
+  for pl in pipelines:
+    log.info('Pipeline {}: inbox: {}, DB Table: {}.'\
+             ''.format(pl.name, pl.inbox_dir, pl.healthpro_table_name))
+  checks = start_startup_checks()
+  observer = None
+  ingest_queue = IngestQueue(process_files, 
+                             ingest_workers or len(pipelines),
+                             window_secs=coalesce_secs)
+  metrics_registry.queue_depth_func = ingest_queue.depth
   try:
-    if not do_startup_checks():
+    # Start watching as soon as the inboxes and archives check out; files
+    # deposited while the db checks finish wait in ingest_queue until they
+    # pass.
+    if not wait_for_checks([x for x in checks if not x[2]]):
       raise Exception('One or more startup checks failed')
-    class FSEHandler(FileSystemEventHandler):
-      # Here we define what we'd like to do when certain filesystem
-      # events take place -- e.g., when a new CSV appears in the watched
-      # directory.
-      # Uncomment on_any_event for extra logging.
-      #def on_any_event(self, event):
-      #  log.info('FSEHandler->on_any_event: event_type=[' \
-      #           '{}], src_path=[{}]'.format(event.event_type, event.src_path))
-      def on_deleted(self, event):
-        # Our forked Watchdog (v0.8.3.1) emits this event when inbox folder 
-        # unmounts (or otherwise is not available).
-        # We log and send an email only once. It very well might remount without 
-        # us needing to do anything.
-        global inbox_gone_flag
-        if event.src_path == inbox_dir:
-          if not inbox_gone_flag:
-            inbox_gone_flag = True
-            msg = event.src_path + ' is gone!'
-            log.error(msg)
-            send_notice_email(msg) 
-      def on_created(self, event):
-        # In on_deleted above, we set the inbox_gone_flag. But if a file appears
-        # we know the inbox is back and all is well; so unset it. 
-        global inbox_gone_flag
-        if inbox_gone_flag:
-          inbox_gone_flag = False
-        log.info('FSEHandler->on_created: a new file has appeared: '
-                 + event.src_path)
-        process_file(event.src_path)
+    if metrics_port:
+      start_metrics_server(metrics_host, metrics_port)
+    # Only now that the inboxes have checked out, since it looks up their
+    # filesystems.
+    observer = make_observer()
     observe_subdirs_flag = False
-    observer.schedule(FSEHandler(), inbox_dir, observe_subdirs_flag)
+    for pl in pipelines:
+      observer.schedule(make_handler_obj(pl, ingest_queue.put), pl.inbox_dir,
+                        observe_subdirs_flag)
     observer.start()
+    log.info('Watching inboxes.')
+    if not wait_for_checks([x for x in checks if x[2]]):
+      raise Exception('One or more startup checks failed')
+    ingest_queue.start()
     log.info('Waiting for activity...')
     print 'Service started.' 
     try:
       while True:
         observer.join(10)
-        if observer.is_alive():
-          continue
-        else:
+        if not observer.is_alive():
           raise Exception('Observer thread has stopped.')
+        if not ingest_queue.is_alive():
+          raise Exception('Ingest worker thread has stopped.')
     except KeyboardInterrupt:
       print '\nKeyboard interrupt caught. Quitting.'
       observer.stop()
+      ingest_queue.stop()
+      db_pool.close_all()
       sys.exit(0)
     observer.join() 
   except Exception, ex:
     print '\nError caught. Quitting. Check log.'
     log.error(str(ex))
     send_error_email('An error occurred in main(). Please check.')
-    observer.stop()
+    if observer:
+      observer.stop()
+    db_pool.close_all()
     sys.exit(1)
 
 #-----------------------------------------------------------------------------
@@ -0,0 +1,11 @@
+-- Optional secondary indexes on the HealthPro table, for queries that join
+-- on [PMI ID] or [Biobank ID]. If you use a staging table, create the same
+-- indexes on it too (with the same names). To have them disabled while the
+-- table is loaded and rebuilt once afterwards (rather than updated row by
+-- row), list their names in the "suspend_indexes" setting.
+
+create nonclustered index [ix_healthpro_pmi_id] 
+  on [dm_aou].[dbo].[healthpro] ([PMI ID]);
+
+create nonclustered index [ix_healthpro_biobank_id] 
+  on [dm_aou].[dbo].[healthpro] ([Biobank ID]);
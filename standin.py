@@ -0,0 +1,227 @@
+'''A local stand-in for SQL Server, backed by SQLite, so the ingester can be
+run and tested without a SQL Server instance. To use it, set db_backend to
+'standin' in the config file and give db_info a 'database' (path to a 
+SQLite file) and optionally 'jobs' (a map of Agent job name to a path of a
+SQLite script that the job runs). The tables need to be created up front.
+It understands just enough T-SQL for the statements in main.py: 
+fully-qualified bracketed table names, truncate, N'' literals, @@version,
+information_schema.columns, and the Agent job procs (a job runs to 
+completion as soon as it's started).'''
+
+import re
+import time
+import sqlite3
+
+SWITCH_RE = re.compile(
+    r"\s*alter\s+table\s+(\S+)\s+switch\s+to\s+(\S+)\s*$", re.I)
+HELP_JOB_RE = re.compile(
+    r"\s*exec\s+msdb\.dbo\.sp_help_job\s+@job_name\s*=\s*N?'([^']*)'", re.I)
+# SQLite always lets you set an integer primary key.
+IDENTITY_INSERT_RE = re.compile(r"\s*set\s+identity_insert\s", re.I)
+# SQLite indexes can't be disabled; rebuilding one is a reindex.
+ALTER_INDEX_RE = re.compile(
+    r"\s*alter\s+index\s+(\S+)\s+on\s+\S+\s+(disable|rebuild)\s*$", re.I)
+
+def tsql_to_sqlite(stmt, has_params):
+  '''Translate one of the ingester's T-SQL statements into SQLite.'''
+  # [db].[schema].[table] -> [table]
+  stmt = re.sub(r'(?:\[[^\]]*\]\.)+(\[[^\]]*\])', r'\1', stmt)
+  stmt = re.sub(r'(?:\[?\w+\]?\.)?information_schema\.columns',
+                'information_schema_columns', stmt, flags=re.I)
+  stmt = re.sub(r'\btruncate\s+table\b', 'delete from', stmt, flags=re.I)
+  stmt = re.sub(r'@@version\b', 'sqlite_version()', stmt, flags=re.I)
+  stmt = re.sub(r"(?<![\w\]])N'", "'", stmt)
+  if has_params:
+    stmt = stmt.replace('%s', '?')
+  return stmt
+
+def ddl_to_sqlite(sql):
+  '''Translate a create-table script (like those in sql/) into SQLite.'''
+  sql = re.sub(r'(?:\[[^\]]*\]\.)+(\[[^\]]*\])', r'\1', sql)
+  sql = re.sub(r'(?i)\bbigint\s+not\s+null\s+identity\(1,\s*1\)\s+'
+               r'primary\s+key', 'integer primary key', sql)
+  sql = re.sub(r'(?i)getdate\(\)', "(datetime('now', 'localtime'))", sql)
+  sql = re.sub(r'(?i)\(max\)', '', sql)
+  sql = re.sub(r'(?is)\)\s*on\s+\[primary\].*', ')', sql)
+  return sql
+
+def create_db(path, scripts):
+  '''Create the SQLite file at path, running each of scripts (T-SQL
+  create-table scripts) in it.'''
+  db = sqlite3.connect(path)
+  try:
+    for sql in scripts:
+      db.executescript(ddl_to_sqlite(sql))
+    db.commit()
+  finally:
+    db.close()
+
+class StandInCursor(object):
+  def __init__(self, conn, as_dict):
+    self._conn = conn
+    self._cur = conn._db.cursor()
+    self._rows = None # Set for results we make up ourselves.
+    self.as_dict = as_dict
+
+  def execute(self, stmt, params=None):
+    self._rows = None
+    m = HELP_JOB_RE.match(stmt)
+    if m:
+      self._rows = [self._conn._job_status(m.group(1))]
+      return
+    if IDENTITY_INSERT_RE.match(stmt):
+      return
+    m = ALTER_INDEX_RE.match(stmt)
+    if m:
+      if m.group(2).lower() == 'rebuild':
+        self._conn._begin()
+        self._cur.execute('reindex ' + m.group(1))
+      return
+    self._conn._begin()
+    m = SWITCH_RE.match(tsql_to_sqlite(stmt, False))
+    if m:
+      # Move all the rows over; the target is expected to be empty.
+      self._cur.execute('insert into ' + m.group(2) + ' select * from '
+                        + m.group(1))
+      self._cur.execute('delete from ' + m.group(1))
+      return
+    if 'information_schema' in stmt.lower():
+      self._conn._refresh_information_schema()
+    self._cur.execute(tsql_to_sqlite(stmt, params is not None), params or ())
+
+  def executemany(self, stmt, seq_of_params):
+    self._rows = None
+    self._conn._begin()
+    self._cur.executemany(tsql_to_sqlite(stmt, True), seq_of_params)
+
+  def bulk_copy(self, table_name, columns, rows):
+    '''The stand-in's fast path for db_bulk_insert.'''
+    self.executemany('insert into ' + table_name + ' ([' + '],['.join(columns)
+                     + ']) values (' + ','.join('%s' for _ in columns) + ')',
+                     rows)
+
+  def callproc(self, name, params=()):
+    if name.lower() == 'msdb.dbo.sp_start_job':
+      self._conn._run_job(params[0])
+    else:
+      raise sqlite3.OperationalError('Stand-in has no procedure ' + name)
+
+  def fetchall(self):
+    if self._rows is not None:
+      rows, self._rows = self._rows, []
+      return rows if self.as_dict else [tuple(r.values()) for r in rows]
+    rows = self._cur.fetchall()
+    if not self.as_dict:
+      return rows
+    cols = [d[0] for d in self._cur.description]
+    return [dict(zip(cols, r)) for r in rows]
+
+  def fetchone(self):
+    rows = self.fetchall()
+    return rows[0] if rows else None
+
+class StandInConnection(object):
+  '''Stands in for a pymssql connection. log (optional) is a logger that 
+  failed jobs are logged to.'''
+
+  def __init__(self, database, jobs=None, log=None):
+    self.database = database
+    self.jobs = jobs or {}
+    self.log = log
+    # We issue begin/commit ourselves (isolation_level=None) so that DDL
+    # is transactional, like it is in SQL Server.
+    self._db = sqlite3.connect(database, timeout=60, isolation_level=None,
+                               check_same_thread=False)
+    self._db.text_factory = str
+    self._in_txn = False
+    self._db.execute('create table if not exists standin_jobs ('
+                     'job_name text primary key, last_run_outcome int, '
+                     'last_run_date int, last_run_time int)')
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def cursor(self, as_dict=False):
+    return StandInCursor(self, as_dict)
+
+  def _begin(self):
+    if not self._in_txn:
+      self._db.execute('begin')
+      self._in_txn = True
+
+  def commit(self):
+    if self._in_txn:
+      self._in_txn = False
+      self._db.execute('commit')
+
+  def rollback(self):
+    if self._in_txn:
+      self._in_txn = False
+      self._db.execute('rollback')
+
+  def close(self):
+    self._db.close()
+
+  def _refresh_information_schema(self):
+    db = self._db
+    db.execute('create temp table if not exists information_schema_columns ('
+               'table_catalog text, table_schema text, table_name text, '
+               'column_name text, ordinal_position int, data_type text, '
+               'character_maximum_length int)')
+    db.execute('delete from information_schema_columns')
+    tables = db.execute("select name from sqlite_master where type = 'table'"
+                        " and name not like 'sqlite_%'").fetchall()
+    for (table_name,) in tables:
+      for col in db.execute('pragma table_info([' + table_name 
+                            + '])').fetchall():
+        # col is (cid, name, declared type, notnull, default, pk)
+        # SQLite won't take (max) as a size; create such columns with (-1),
+        # which is what information_schema reports for them anyway.
+        m = re.match(r'\s*(\w*)\s*(?:\(\s*(-?\w+)\s*\))?', col[2] or '')
+        size = m.group(2)
+        maxlen = -1 if size == 'max' else int(size) if size else None
+        db.execute('insert into information_schema_columns values '
+                   '(?,?,?,?,?,?,?)', (None, 'dbo', table_name, col[1],
+                                       col[0] + 1, m.group(1).lower(), maxlen))
+
+  def _run_job(self, job_name):
+    # Like a real Agent job, this runs on its own connection.
+    outcome = 1 # Succeeded.
+    script = self.jobs.get(job_name)
+    if script:
+      job_db = sqlite3.connect(self.database, timeout=60)
+      job_db.text_factory = str
+      try:
+        with open(script) as f:
+          job_db.executescript(f.read())
+      except sqlite3.Error, ex:
+        if self.log:
+          self.log.error('Stand-in job [{}] failed: {}'.format(job_name, ex))
+        outcome = 0 # Failed.
+      finally:
+        job_db.close()
+    now = time.localtime()
+    run_date = int(time.strftime('%Y%m%d', now))
+    run_time = int(time.strftime('%H%M%S', now))
+    # The last run is told apart from the one before it by date and time 
+    # (see JobRun), which can't happen if both were within the same second.
+    before = self._job_status(job_name)
+    if (before['last_run_date'], before['last_run_time']) == (run_date, 
+                                                             run_time):
+      run_time += 1
+    self._db.execute('insert or replace into standin_jobs values (?,?,?,?)',
+                     (job_name, outcome, run_date, run_time))
+
+  def _job_status(self, job_name):
+    '''Made-up result row of sp_help_job.'''
+    row = self._db.execute('select last_run_outcome, last_run_date, '
+                           'last_run_time from standin_jobs where job_name = ?',
+                           (job_name,)).fetchone()
+    outcome, run_date, run_time = row or (5, 0, 0) # 5 means unknown.
+    return {'current_execution_status': 4, # 4 means idle.
+            'last_run_outcome': outcome,
+            'last_run_date': run_date,
+            'last_run_time': run_time}
@@ -0,0 +1,136 @@
+'''Shared setup for the tests. main reads its config (and writes its log)
+relative to the current folder when it's imported, so on import this sets up
+a temp work folder -- config file, inbox, archive, and a stand-in db (see
+standin.py) with the tables from sql/ plus a HealthPro staging table --
+changes into it, and imports main. The folder is deleted at exit.
+
+The tests need the ingester's dependencies installed; run them from the
+repo folder with:
+
+  python -m unittest discover -s tests'''
+
+import os
+import sys
+import json
+import atexit
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.normpath(os.path.join(HERE, '..'))
+sys.path[:0] = [REPO, os.path.join(REPO, 'bench')]
+import standin
+import workqueue
+
+WORK_DIR = tempfile.mkdtemp(prefix='ingester-tests-')
+atexit.register(shutil.rmtree, WORK_DIR, True)
+DB_PATH = os.path.join(WORK_DIR, 'standin.sqlite')
+INBOX_DIR = os.path.join(WORK_DIR, 'inbox')
+ARCHIVE_DIR = os.path.join(WORK_DIR, 'archive')
+
+HP_TABLE = '[dm_aou].[dbo].[healthpro]'
+HP_STAGING_TABLE = '[dm_aou].[dbo].[healthpro_staging]'
+TABLES = ['healthpro', 'healthpro_staging', 'metadata', 'rc_prj_2525']
+
+# The stand-in REDCap job just puts a row in the REDCap table.
+REDCAP_JOB_SQL = 'insert into rc_prj_2525 (project_id, record) '\
+                 "values (2525, 'test');"
+
+def setup_work_dir():
+  os.mkdir(os.path.join(WORK_DIR, 'enclave'))
+  os.mkdir(INBOX_DIR)
+  os.mkdir(ARCHIVE_DIR)
+  job_path = os.path.join(WORK_DIR, 'redcap_job.sql')
+  with open(job_path, 'w') as f:
+    f.write(REDCAP_JOB_SQL)
+  cfg = {'db_info': {'host': 'standin', 'database': DB_PATH,
+                     'jobs': {'redcap': job_path}},
+         'db_backend': 'standin',
+         'from_email': 'test@example.com', 'to_email': 'test@example.com',
+         'notify_backend': 'file',
+         'consortium_tag': 'TEST',
+         'inbox_dir': INBOX_DIR,
+         'archive_dir': ARCHIVE_DIR,
+         'healthpro_table_name': HP_TABLE,
+         'metadata_table_name': '[dm_aou].[dbo].[metadata]',
+         'redcap_table_name': '[dm_aou].[dbo].[rc_prj_2525]',
+         'redcap_job_name': 'redcap',
+         'agent_job_timeout': 60}
+  with open(os.path.join(WORK_DIR, 'enclave',
+                         'healthproimporter_config.json'), 'w') as f:
+    json.dump(cfg, f, indent=1)
+  scripts = []
+  for fname in ['create-healthpro-table.sql', 'create-metadata-table.sql',
+                'create-redcap-table.sql']:
+    with open(os.path.join(REPO, 'sql', fname)) as f:
+      scripts.append(f.read())
+  scripts.append(scripts[0].replace('[healthpro]', '[healthpro_staging]'))
+  standin.create_db(DB_PATH, scripts)
+
+setup_work_dir()
+os.chdir(WORK_DIR)
+import main
+
+def csv_path(snapshot):
+  '''Path in the inbox of a CSV with a properly formed name; snapshot is
+  like '20180101-000000'.'''
+  return os.path.join(INBOX_DIR, 'workqueue_TEST_{}.csv'.format(snapshot))
+
+def write_csv(snapshot, nrows, seed=0):
+  '''Write a Work Queue CSV (see bench/workqueue.py) into the inbox;
+  returns its path.'''
+  path = csv_path(snapshot)
+  workqueue.write_workqueue(path, nrows, seed)
+  return path
+
+def table_rows(table_name):
+  '''All rows of a table (named as in the config), in rid order (for those
+  that have one).'''
+  db = sqlite3.connect(DB_PATH)
+  try:
+    cursor = db.execute(standin.tsql_to_sqlite('select * from ' + table_name,
+                                               False))
+    cols = [d[0] for d in cursor.description]
+    rows = cursor.fetchall()
+  finally:
+    db.close()
+  if 'rid' in cols:
+    rows.sort(key=lambda r: r[cols.index('rid')])
+  return rows
+
+class IngesterTestCase(unittest.TestCase):
+  '''Starts each test with empty tables, inbox, and archive, and the
+  pipeline's settings as configured. Use patch to change a setting or
+  function of main (or of the pipeline) for the length of a test.'''
+
+  def setUp(self):
+    self.pl = main.pipelines[0]
+    self.reset()
+    self.patch(main, 'file_ready_quiet_secs', 0)
+    self.patch(main, 'FILE_READY_POLL_SECS', 0.01)
+    self.patch(main, 'JOB_POLL_MIN_SECS', 0.01)
+
+  def reset(self):
+    '''Empty the tables, inbox, and archive, and forget earlier ingests.'''
+    main.db_pool.close_all()
+    db = sqlite3.connect(DB_PATH)
+    for t in TABLES:
+      db.execute('delete from ' + t)
+    db.commit()
+    db.close()
+    for d in [INBOX_DIR, ARCHIVE_DIR]:
+      shutil.rmtree(d)
+      os.mkdir(d)
+    for path in [self.pl.delta_snapshot_path, self.pl.ingest_index_path]:
+      if os.path.exists(path):
+        os.remove(path)
+    self.pl._ingest_index = None
+    main.ready_file_stats.clear()
+    main.datetime_cache.clear()
+
+  def patch(self, obj, name, value):
+    old = getattr(obj, name)
+    setattr(obj, name, value)
+    self.addCleanup(setattr, obj, name, old)
@@ -0,0 +1,45 @@
+'''Type conversion (see type conversion in main.py).'''
+
+import datetime
+import unittest
+
+from support import main, HP_TABLE
+
+class RowConverterTest(unittest.TestCase):
+
+  def setUp(self):
+    self.columns = ['PMI ID', 'General Consent Status']
+    self.converter = main.RowConverter(self.columns,
+                                       main.db_column_info_for(HP_TABLE))
+
+  def convert(self, row):
+    # New string objects, as the CSV reader would give.
+    return self.converter.convert(1, [''.join(list(v)) for v in row])
+
+  def test_interns_narrow_columns_only(self):
+    a = self.convert(['P000000001', '10'])
+    b = self.convert(['P000000001', '10'])
+    self.assertIs(a[1], b[1])
+    self.assertIsNot(a[0], b[0])
+
+class ParseDatetimeCellTest(unittest.TestCase):
+
+  def setUp(self):
+    main.datetime_cache.clear()
+
+  def test_healthpro_formats(self):
+    self.assertEqual(main.parse_datetime_cell('1/5/2018'),
+                     datetime.datetime(2018, 1, 5))
+    self.assertEqual(main.parse_datetime_cell('2018-01-05'),
+                     datetime.datetime(2018, 1, 5))
+    self.assertEqual(main.parse_datetime_cell('01/05/2018 3:04 PM'),
+                     datetime.datetime(2018, 1, 5, 15, 4))
+    self.assertIsNone(main.parse_datetime_cell(' '))
+
+  def test_rejects_partial_dates(self):
+    for s in ['5', '2018', 'Jan', '3.5', '1/5', '1/5/18', '13/1/2018']:
+      with self.assertRaises(ValueError):
+        main.parse_datetime_cell(s)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,89 @@
+'''Delta loads (see delta loads in main.py).'''
+
+import os
+import unittest
+
+from support import main, IngesterTestCase, HP_TABLE, table_rows, write_csv
+
+COLUMNS = ['PMI ID', 'Last Name']
+
+class LoadDeltaTest(IngesterTestCase):
+
+  def load(self, rows):
+    snapshot = main.DeltaSnapshot(self.pl.delta_snapshot_path, HP_TABLE)
+    try:
+      counts = main.load_delta_into_db(HP_TABLE, COLUMNS, rows, snapshot)
+      snapshot.commit()
+    finally:
+      snapshot.close()
+    return counts
+
+  def names(self):
+    return sorted((r[1], r[3]) for r in table_rows(HP_TABLE))
+
+  def test_first_load_is_full(self):
+    counts = self.load([('P1', 'a'), ('P2', 'b')])
+    self.assertEqual(counts, main.DeltaCounts(2, 0, 0))
+    self.assertEqual(self.names(), [('P1', 'a'), ('P2', 'b')])
+
+  def test_applies_differences(self):
+    self.load([('P1', 'a'), ('P2', 'b'), ('P3', 'c')])
+    counts = self.load([('P1', 'a'), ('P3', 'x'), ('P4', 'd')])
+    self.assertEqual(counts, main.DeltaCounts(1, 1, 1))
+    self.assertEqual(self.names(), [('P1', 'a'), ('P3', 'x'), ('P4', 'd')])
+
+  def test_duplicate_key_rejected(self):
+    self.load([('P1', 'a')])
+    with self.assertRaises(main.CsvRejectedException):
+      self.load([('P1', 'a'), ('P1', 'b')])
+    self.assertEqual(self.names(), [('P1', 'a')])
+
+class DeltaIngestTest(IngesterTestCase):
+
+  def setUp(self):
+    IngesterTestCase.setUp(self)
+    self.patch(self.pl, 'load_mode', 'delta')
+
+  def ingest(self, snapshot, nrows, seed=0):
+    self.assertTrue(main.process_file(self.pl,
+                                      write_csv(snapshot, nrows, seed)))
+
+  def pmi_ids(self):
+    return [r[1] for r in table_rows(HP_TABLE)]
+
+  def test_changed_rows(self):
+    self.ingest('20180101-000000', 100)
+    self.ingest('20180102-000000', 120)
+    self.ingest('20180103-000000', 120, seed=1)
+    ids = self.pmi_ids()
+    self.assertEqual(len(ids), 120)
+    self.assertEqual(len(set(ids)), 120)
+
+  def test_snapshot_behind_table(self):
+    # As if the process died after the db commit but before the snapshot's.
+    self.ingest('20180101-000000', 100)
+    commit = main.DeltaSnapshot.__dict__['commit']
+    main.DeltaSnapshot.commit = lambda self: None
+    try:
+      self.ingest('20180102-000000', 120)
+    finally:
+      main.DeltaSnapshot.commit = commit
+    self.ingest('20180103-000000', 125)
+    ids = self.pmi_ids()
+    self.assertEqual(len(ids), 125)
+    self.assertEqual(len(set(ids)), 125)
+
+  def test_table_out_of_step(self):
+    self.ingest('20180101-000000', 100)
+    main.db_stmt('delete from ' + HP_TABLE + ' where rid <= 10')
+    before = table_rows(HP_TABLE)
+    self.assertFalse(main.process_file(self.pl,
+                                       write_csv('20180102-000000', 110)))
+    self.assertEqual(table_rows(HP_TABLE), before)
+    self.assertFalse(os.path.exists(self.pl.delta_snapshot_path))
+    # So the next ingest is a full reload.
+    self.ingest('20180103-000000', 110)
+    self.assertEqual(len(set(self.pmi_ids())), 110)
+
+if __name__ == '__main__':
+  unittest.main()
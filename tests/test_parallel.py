@@ -0,0 +1,133 @@
+'''Parallel loads (see parallel loads in main.py).'''
+
+import csv
+import unittest
+from StringIO import StringIO
+
+from support import main, IngesterTestCase, HP_TABLE, HP_STAGING_TABLE, \
+                    table_rows, write_csv
+
+# Values with newlines and (escaped) quotes in them.
+RECORDS = [['P{}'.format(i), 'line 1\nline "{}"\n'.format(i) * (i % 3),
+            'x' * (i % 7)] for i in range(200)]
+
+def csv_bytes(records):
+  buf = StringIO()
+  csv.writer(buf, lineterminator='\n').writerows(records)
+  return buf.getvalue()
+
+class RecordBoundariesTest(unittest.TestCase):
+
+  def test_splits_at_record_boundaries(self):
+    data = csv_bytes(RECORDS)
+    for chunk_bytes in [1, 10, 64, 1000, len(data)]:
+      starts = main.record_boundaries(StringIO(data), 0, len(data),
+                                      chunk_bytes)
+      self.assertEqual(starts[0], 0)
+      self.assertEqual(starts, sorted(set(starts)))
+      chunks = zip(starts, starts[1:] + [len(data)])
+      records = []
+      for start, end in chunks:
+        records.extend(csv.reader(StringIO(data[start:end])))
+      self.assertEqual(records, RECORDS)
+
+  def test_between_offsets(self):
+    data = csv_bytes(RECORDS)
+    start = len(csv_bytes(RECORDS[:10]))
+    end = len(csv_bytes(RECORDS[:150]))
+    starts = main.record_boundaries(StringIO(data), start, end, 100)
+    self.assertEqual(starts[0], start)
+    self.assertTrue(starts[-1] < end)
+    records = []
+    for a, b in zip(starts, starts[1:] + [end]):
+      records.extend(csv.reader(StringIO(data[a:b])))
+    self.assertEqual(records, RECORDS[10:150])
+
+class ParallelLoadTest(IngesterTestCase):
+
+  def setUp(self):
+    IngesterTestCase.setUp(self)
+    self.patch(main, 'parallel_chunk_bytes', 8 * 1024)
+    self.patch(self.pl, 'healthpro_staging_table_name', HP_STAGING_TABLE)
+    # Results of load_data_in_parallel, to check the loads were parallel.
+    self.parallel = []
+    load = main.load_data_in_parallel
+    def load_data_in_parallel(*args):
+      self.parallel.append(load(*args))
+      return self.parallel[-1]
+    self.patch(main, 'load_data_in_parallel', load_data_in_parallel)
+
+  def load(self, nworkers):
+    self.reset()
+    self.patch(self.pl, 'parallel_workers', nworkers)
+    self.assertTrue(main.process_file(self.pl,
+                                      write_csv('20180101-000000', 500)))
+    return table_rows(HP_TABLE)
+
+  def test_same_as_serial(self):
+    serial = self.load(1)
+    self.assertEqual(len(serial), 500)
+    self.assertEqual(self.load(3), serial)
+    self.assertEqual(self.parallel, [True])
+
+  def test_serial_with_sort_key(self):
+    self.patch(self.pl, 'sort_key', ['Last Name', 'PMI ID'])
+    rows = self.load(3)
+    self.assertEqual(self.parallel, [])
+    self.assertEqual(len(rows), 500)
+    self.assertEqual(rows, sorted(rows, key=lambda r: (r[3], r[1])))
+
+  def test_rejects_bad_rows(self):
+    self.patch(self.pl, 'parallel_workers', 3)
+    self.assertTrue(main.process_file(self.pl,
+                                      write_csv('20180101-000000', 300)))
+    path = write_csv('20180102-000000', 400)
+    with open(path, 'rb') as f:
+      data = f.read()
+    # A bad date in the last chunk.
+    i = data.rindex('/2018"')
+    with open(path, 'wb') as f:
+      f.write(data[:i] + '/2018x' + data[i + len('/2018'):])
+    self.assertFalse(main.process_file(self.pl, path))
+    self.assertEqual(len(table_rows(HP_TABLE)), 300)
+    self.assertEqual(self.parallel, [True, True])
+
+def fail(*args):
+  raise Exception('failed')
+
+class SuspendIndexesTest(IngesterTestCase):
+  '''A failed serial load's rollback re-enables the indexes, so they're 
+  only rebuilt after a load that worked; a parallel load's workers commit
+  as they go, so it always rebuilds them.'''
+
+  def setUp(self):
+    IngesterTestCase.setUp(self)
+    self.rebuilt = []
+    self.patch(main, 'db_rebuild_indexes',
+               lambda table_name, names: self.rebuilt.append(table_name))
+    self.path = write_csv('20180101-000000', 100)
+    self.csvfile, self.rows = main.handle_csv(self.path)
+    self.converter = main.RowConverter(
+        self.csvfile.header, main.db_column_info_for(HP_STAGING_TABLE))
+
+  def test_serial(self):
+    main.load_data_into_db(HP_STAGING_TABLE, self.csvfile.header, 
+                           self.converter.convert_rows(self.rows), ['ix'])
+    self.assertEqual(self.rebuilt, [HP_STAGING_TABLE])
+    del self.rebuilt[:]
+    self.patch(main, 'db_bulk_insert', fail)
+    with self.assertRaises(Exception):
+      main.load_data_into_db(HP_STAGING_TABLE, self.csvfile.header, [], 
+                             ['ix'])
+    self.assertEqual(self.rebuilt, [])
+
+  def test_parallel_failed(self):
+    self.patch(main, 'parallel_chunk_bytes', 8 * 1024)
+    self.patch(main, 'load_chunk', fail) # Run by the workers.
+    with self.assertRaisesRegexp(Exception, 'failed'):
+      main.load_data_in_parallel(self.csvfile, HP_STAGING_TABLE, 
+                                 self.converter, 2, ['ix'])
+    self.assertEqual(self.rebuilt, [HP_STAGING_TABLE])
+
+if __name__ == '__main__':
+  unittest.main()
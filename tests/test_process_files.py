@@ -0,0 +1,151 @@
+'''Handling of files deposited in an inbox: the ingest queue, and
+process_files.'''
+
+import os
+import unittest
+
+from watchdog.events import FileCreatedEvent, FileDeletedEvent
+
+from support import main, IngesterTestCase, HP_TABLE, INBOX_DIR, table_rows, \
+                    write_csv
+
+class RequeueTest(IngesterTestCase):
+
+  def test_unchanged_requeue_skipped(self):
+    path = write_csv('20180101-000000', 10)
+    self.assertTrue(main.wait_for_file_ready(path))
+    main.process_files(self.pl, [path], set([path]))
+    self.assertTrue(os.path.exists(path))
+    self.assertEqual(table_rows(HP_TABLE), [])
+    # A file that wasn't just re-queued is processed even if it's unchanged.
+    main.process_files(self.pl, [path])
+    self.assertFalse(os.path.exists(path))
+    self.assertEqual(len(table_rows(HP_TABLE)), 10)
+
+  def test_changed_requeue_processed(self):
+    path = write_csv('20180101-000000', 10)
+    self.assertTrue(main.wait_for_file_ready(path))
+    write_csv('20180101-000000', 12)
+    main.process_files(self.pl, [path], set([path]))
+    self.assertEqual(len(table_rows(HP_TABLE)), 12)
+
+  def test_created_or_deleted_file_forgotten(self):
+    handler = main.make_handler_obj(self.pl, lambda *args: None)
+    path = write_csv('20180101-000000', 10)
+    self.assertTrue(main.wait_for_file_ready(path))
+    handler.on_created(FileCreatedEvent(path))
+    self.assertTrue(main.changed_since_ready(path))
+    self.assertTrue(main.wait_for_file_ready(path))
+    handler.on_deleted(FileDeletedEvent(path))
+    self.assertTrue(main.changed_since_ready(path))
+
+  def test_queue_tracks_requeues(self):
+    queue = main.IngestQueue(None)
+    a, b = write_csv('20180101-000000', 1), write_csv('20180102-000000', 1)
+    queue.put(self.pl, a, True)
+    queue.put(self.pl, b, True)
+    queue.put(self.pl, a) # Deposited anew.
+    queue.put(self.pl, b, True)
+    self.assertEqual(queue._take(), (self.pl, [a, b], set([b])))
+
+class CoalesceTest(IngesterTestCase):
+
+  def setUp(self):
+    IngesterTestCase.setUp(self)
+    # Names of the files process_file is called on.
+    self.processed = []
+    process_file = main.process_file
+    def record(pl, path):
+      self.processed.append(os.path.basename(path))
+      return process_file(pl, path)
+    self.patch(main, 'process_file', record)
+
+  def superseded(self):
+    rows = table_rows('[dm_aou].[dbo].[metadata]')
+    return sorted(r[3].split()[0] for r in rows
+                  if r[2] == 'healthpro-superseded')
+
+  def test_newest_loaded(self):
+    paths = [write_csv('20180102-000000', 12),
+             write_csv('20180103-000000', 13),
+             write_csv('20180101-000000', 11)]
+    main.process_files(self.pl, paths)
+    self.assertEqual(self.processed, ['workqueue_TEST_20180103-000000.csv'])
+    self.assertEqual(len(table_rows(HP_TABLE)), 13)
+    self.assertEqual(self.superseded(),
+                     ['workqueue_TEST_20180101-000000.csv',
+                      'workqueue_TEST_20180102-000000.csv'])
+    self.assertEqual(os.listdir(INBOX_DIR), [])
+
+  def test_next_newest_if_newest_rejected(self):
+    paths = [write_csv('20180101-000000', 11),
+             write_csv('20180102-000000', 12)]
+    with open(paths[1], 'ab') as f:
+      f.write('garbage\n')
+    main.process_files(self.pl, paths)
+    self.assertEqual(self.processed, ['workqueue_TEST_20180102-000000.csv',
+                                      'workqueue_TEST_20180101-000000.csv'])
+    self.assertEqual(len(table_rows(HP_TABLE)), 11)
+
+  def test_older_than_ingested_superseded(self):
+    main.process_files(self.pl, [write_csv('20180102-000000', 12)])
+    main.process_files(self.pl, [write_csv('20180101-000000', 13),
+                                 write_csv('20180102-000000', 14)])
+    self.assertEqual(self.processed, ['workqueue_TEST_20180102-000000.csv'])
+    self.assertEqual(len(table_rows(HP_TABLE)), 12)
+    self.assertEqual(self.superseded(),
+                     ['workqueue_TEST_20180101-000000.csv',
+                      'workqueue_TEST_20180102-000000.csv'])
+    self.assertEqual(os.listdir(INBOX_DIR), [])
+
+  def test_takes_files_that_arrive_meanwhile(self):
+    older = write_csv('20180101-000000', 11)
+    newer = write_csv('20180102-000000', 12)
+    main.process_files(self.pl, [older], (), lambda: ([newer], set()))
+    self.assertEqual(self.processed, ['workqueue_TEST_20180102-000000.csv'])
+    self.assertEqual(len(table_rows(HP_TABLE)), 12)
+    self.assertEqual(self.superseded(),
+                     ['workqueue_TEST_20180101-000000.csv'])
+
+class ConcurrentRefreshTest(IngesterTestCase):
+
+  def setUp(self):
+    IngesterTestCase.setUp(self)
+    self.patch(self.pl, 'concurrent_redcap_refresh', True)
+    self.emails = [] # (category, message)
+    self.patch(main.notifier, 'notify',
+               lambda category, msg, once_key=None:
+                   self.emails.append((category, msg)))
+
+  def bad_csv(self):
+    '''A CSV that passes the quick checks, but has a bad date.'''
+    path = write_csv('20180101-000000', 10)
+    with open(path, 'rb') as f:
+      data = f.read()
+    i = data.index('/2018"')
+    with open(path, 'wb') as f:
+      f.write(data[:i] + '/2018x' + data[i + len('/2018'):])
+    return path
+
+  def test_loaded(self):
+    self.assertTrue(main.process_file(self.pl,
+                                      write_csv('20180101-000000', 10)))
+    self.assertEqual([c for c, _ in self.emails], ['success'])
+    self.assertEqual(len(table_rows('[dm_aou].[dbo].[rc_prj_2525]')), 1)
+
+  def test_rejected(self):
+    self.assertFalse(main.process_file(self.pl, self.bad_csv()))
+    self.assertEqual([c for c, _ in self.emails], ['notice'])
+    self.assertEqual(len(table_rows('[dm_aou].[dbo].[rc_prj_2525]')), 1)
+
+  def test_rejected_and_refresh_failed(self):
+    self.patch(main, 'refresh_redcap_table', lambda pl: False)
+    self.assertFalse(main.process_file(self.pl, self.bad_csv()))
+    self.assertEqual(len(self.emails), 1)
+    category, msg = self.emails[0]
+    self.assertEqual(category, 'error')
+    self.assertIn('not processed', msg)
+    self.assertIn('refreshing REDCap data', msg)
+
+if __name__ == '__main__':
+  unittest.main()